@@ -1,32 +1,119 @@
+import threading
 from utils import *
+from codec import *
+from container import *
+from session import *
+from tally import *
+from registry import *
+from slots import *
+from leaderboard import *
+from importer import *
 
 
 class Backend:
     """The backend services"""
-    def __init__(self, error_handler):
+    def __init__(self, error_handler, journal: bool = False, compact_every: int = 64, workers: int = 0,
+                 flush_every: int = 1, flush_interval: int = 0, session_timeout: float = session_timeout,
+                 slotted: bool = False, shard: str = None, durability: str = "none", commit_window: int = 50):
         """Initialization for the backend services
         
         :param error_handler: The function of the Interface class that handles errors
+        :param journal: Whether to append each store to a journal instead of rewriting the vote file
+        :param compact_every: The number of journal records after which the journal is folded into the vote file
+        :param workers: The number of processes used to encode and decode large vote files (0 to stay serial)
+        :param flush_every: The number of ballots kept in memory before they are written to disk (0 to disable)
+        :param flush_interval: The time (in milliseconds) after which stored ballots are written to disk (0 to disable)
+        Ballots kept in memory are also written by flush() and close(). A timer writes them once
+        flush_interval (or commit_window) has passed, even if no other ballot is stored.
+        :param session_timeout: The time (in seconds) after which an unused session key is forgotten
+        :param slotted: Whether to store the votes in a slotted file (see slots.py), where a store
+        only rewrites the blocks holding the candidates voted for. It can't be used with journal.
+        :param shard: The name of the shard this Backend (terminal) writes to, in votes/<election>/<shard>.dat,
+        so that several terminals can store votes at once. Reading the votes adds up all the shards.
+        :param durability: How safely the votes are written (see utils.durability_levels). Vote files are
+        always replaced in one step, so a crash can't leave a half-written file.
+            "none": The data is left to the operating system to write (the flush policy applies)
+            "batched": The ballots stored within commit_window ms are written together with a single fsync,
+            when the window ends. A crash loses at most the ballots of the current window.
+            "every-ballot": Every store is written and fsynced before it returns (the slowest)
+        :param commit_window: The time (in milliseconds) ballots are grouped for in the "batched" durability level
         """
+        if durability not in durability_levels:
+            raise ValueError("Unknown durability level: " + durability)
+        if journal and slotted:
+            raise ValueError("The journal and slotted modes can't be used together")
         self.error_handler = error_handler
         self.vote_file_name = ""
         self.candidates = {}
-        self._codec = RSCodec(160)
+        self.registry = CandidateRegistry({})  # The IDs of the candidates, see registry.py
+        self.journal = journal
+        self.compact_every = compact_every
+        self.workers = workers
+        self._journal_state = None  # ((filename, log size), last sequence number, records in the log)
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._votes = None          # The vote data of the election, kept in memory
+        self._pending = {}          # The votes not written to disk yet
+        self._pending_ballots = 0
+        self._cache_key = None      # The encryption key of the vote data kept in memory
+        self._signature = None      # The state of the vote files when they were last read or written
+        self._flushed_at = perf_counter()
+        self._flush_timer = None    # Writes the votes kept in memory once the flush interval (or commit window) ends
+        self._lock = threading.RLock()  # Held while the vote data kept in memory is changed, since the timer can flush it
+        self._files_locked = False  # Whether the lock on the vote files is held, see _write_lock()
+        self.session_timeout = session_timeout
+        self.session = None         # The session holding the derived key, see open_session()
+        self.slotted = slotted
+        self._slots = None          # The open slotted file, in slotted mode
+        self._slots_key = None
+        self.shard = shard
+        self.durability = durability
+        self.commit_window = commit_window
+        self._shards = {}           # The vote data of the other shards, with the state of their files
+        self._ranked = {}           # File name -> [key, bytes read, matrices of each category], see store_ranked()
+        self.tally_version = 0      # Goes up whenever the vote data seen by this Backend may have changed
+        self._boards = None         # The leaderboard of each category, see leaderboards()
+        self._boards_version = None # The tally_version the leaderboards match
         
         if not ensure_dir(cand_path):
             debug("Candidates path created")
         if not ensure_dir(vote_path):
             debug("Vote path created")
+        self._codec = get_codec(profiles[default_profile], workers)  # Shared, and its tables cached in vote_path
     
+    @property
+    def file_name(self) -> str:
+        """The name of the vote files this Backend writes to (with the shard, if any)"""
+        return self.vote_file_name if self.shard is None else self.vote_file_name + "/" + self.shard
+
+    @contextmanager
+    def _write_lock(self):
+        """Holds the lock on the vote files of the election (see file_lock) while they are written,
+        so the scrubber can't write back a repair in between. Nested calls share the lock."""
+        with self._lock:
+            if self._files_locked:
+                yield
+                return
+            with file_lock(vote_path + self.file_name):
+                self._files_locked = True
+                try:
+                    yield
+                finally:
+                    self._files_locked = False
+
     def encrypt(self, key: bytes, data: dict) -> bytes:
         """Encrypts the data and encodes it using the RS algorithm.
+        The header records the redundancy profile used.
         
         :param key: The encryption key
         :param data: The data to encrypt
         :returns: The encrypted data
         """
-        f = Fernet(key)
-        return self._codec.encode(f.encrypt(pickle.dumps(data)))
+        return b"".join(self._encrypt_pieces(key, data))
+
+    def _encrypt_pieces(self, key: bytes, data: dict):
+        """Same as encrypt, a piece at a time (see _seal_pieces), to be written as they come"""
+        return self._seal_pieces(key, stage("serialize", pack_tally, data, self.registry.digests))
     
     def decrypt(self, key: bytes, data: bytes) -> dict:
         """Decrypts the data and decodes it using the RS algorithm.
@@ -35,43 +122,206 @@ class Backend:
         :param data: The data to decrypt
         :returns: The decrypted data
         """
-        f = Fernet(key)
         try:
-            return pickle.loads(f.decrypt(bytes(self._codec.decode(data)[0])))
+            return self._deserialize(self._unseal(key, data))
         except Exception as e:
             self.error_handler(e)
             return {}
-    
+
+    def _decrypt_file(self, key: bytes, file, offset: int = 0, size: int = None) -> dict:
+        """Same as decrypt, reading the data from a file a piece at a time (see _unseal_file)"""
+        try:
+            return self._deserialize(self._unseal_file(key, file, offset, size))
+        except Exception as e:
+            self.error_handler(e)
+            return {}
+
+    def _deserialize(self, payload: bytes) -> dict:
+        """:returns: The vote data in the payload (vote files written before the binary format are still pickled)"""
+        if is_tally(payload):
+            return stage("deserialize", unpack_tally, payload, self.registry.digests)
+        return stage("unpickle", pickle.loads, payload)
+
+    def _seal_pieces(self, key: bytes, payload: bytes):
+        """Encrypts bytes into a container (see container.py) and encodes it using the RS algorithm,
+        a window of chunks at a time, so neither the ciphertext nor the encoded data is ever whole in memory
+
+        :param key: The encryption key
+        :param payload: The bytes to encrypt
+        :returns: A generator of the header, the encoded windows and the digest table
+        """
+        codec = self._codec
+        yield pack_header(codec.nsym)
+        digests = []
+        for window in codec.encode_stream(seal_segments(key, payload)):
+            digests.append(stage("digest", codec.digests, window))
+            yield window
+        yield b"".join(digests)
+
+    def _seal(self, key: bytes, payload: bytes) -> bytes:
+        """Encrypts bytes and encodes them using the RS algorithm, all at once (see _seal_pieces)
+
+        :param key: The encryption key
+        :param payload: The bytes to encrypt
+        :returns: The encrypted bytes
+        """
+        return b"".join(self._seal_pieces(key, payload))
+
+    def _unseal(self, key: bytes, data: bytes) -> bytes:
+        """Decodes and decrypts bytes written by _seal (the exceptions are left to the caller)
+
+        :param key: The encryption key
+        :param data: The encrypted bytes
+        :returns: The decrypted bytes
+        """
+        return self._open_sealed(key, unpack_header(data), lambda start, end: (data[start:end],))
+
+    def _unseal_file(self, key: bytes, file, offset: int = 0, size: int = None) -> bytes:
+        """Decodes and decrypts data written by _seal from a file, reading it a piece at a time
+        (the exceptions are left to the caller)
+
+        :param key: The encryption key
+        :param file: The file, open for reading in binary mode
+        :param offset: The position of the data in the file
+        :param size: The size of the data (up to the end of the file by default)
+        :returns: The decrypted bytes
+        """
+        if size is None:
+            size = fstat(file.fileno()).st_size - offset
+        file.seek(offset)
+
+        def read(start: int, end: int):
+            file.seek(offset + start)
+            while start < end:
+                piece = stage("file_read", file.read, min(read_size, end - start))
+                if not piece:
+                    raise EOFError("The vote file is shorter than expected")
+                start += len(piece)
+                yield piece
+        return self._open_sealed(key, unpack_header(file.read(header.size), size), read)
+
+    def _open_sealed(self, key: bytes, layout: tuple, read) -> bytes:
+        """Decodes and decrypts sealed data, a window of chunks (and a container segment) at a time
+
+        :param key: The encryption key
+        :param layout: The layout of the data (see unpack_header)
+        :param read: Called with the start and end of a part of the data, returns it in pieces
+        :returns: The decrypted bytes
+        """
+        version, nsym, (start, end), table = layout
+        codec = self._codec if nsym == self._codec.nsym else get_codec(nsym, self.workers)
+        digests = b"".join(read(*table)) if table else None
+
+        def payload(digests: bytes) -> bytes:
+            decoded = codec.decode_stream(read(start, end), digests)
+            if version < 3:
+                # Files written before containers hold a Fernet token, which can only be decrypted whole
+                return stage("fernet_decrypt", self._cipher(key).decrypt, b"".join(decoded))
+            plain = bytearray()  # Grown in place, so the payload is only in memory once
+            for segment in open_segments(key, decoded):
+                plain += segment
+            return plain
+        try:
+            return payload(digests)
+        except Exception:
+            if not digests:
+                raise
+            # A damaged digest table, or damage its 16-bit digests missed: check every chunk instead
+            debug("Backend: The digests don't match the data, decoding it again without them")
+            return payload(None)
+
     def verify_pin(self, pin) -> bool:
-        """Verifies whether the PIN matches the stored hash
+        """Verifies whether the PIN matches the stored hash (or verifier).
+        With a verifier, the key has to be derived to check the PIN, so a session is opened.
         
         :param pin: The input PIN
         :returns: Whether the PIN is correct or not
         """
         try:
-            return self.candidates[pin_key] == get_pin_hash(pin)
+            if self.registry.verifier is not None:
+                return bool(self._get_key(pin))
+            return self.registry.pin_hash == get_pin_hash(pin)
         except Exception as e:
             self.error_handler(e)
             return False
 
-    def register(self, filename: str, pin: bytes, candidates: dict) -> bytes:
+    def open_session(self, pin: bytes) -> bool:
+        """Derives the encryption key once, and keeps it until
+        logout() is called or the session times out
+
+        :param pin: The PIN
+        :returns: Whether the PIN is correct or not
+        """
+        return bool(self._get_key(pin))
+
+    def logout(self) -> bool:
+        """Writes the votes kept in memory and forgets the session key
+
+        :returns: Whether the votes were stored successfully?
+        """
+        stored = self.close()
+        if self.session:
+            self.session.logout()
+            self.session = None
+        return stored
+
+    def _get_key(self, pin: bytes):
+        """Gets the encryption key from the session, starting a new one if needed
+
+        :param pin: The PIN
+        :returns: The key, or False if the PIN is wrong
+        """
+        pin_hash, salt, verifier = self.registry.pin_hash, self.registry.salt, self.registry.verifier
+        if self.session is None or not self.session.matches(pin_hash, salt, pin):
+            if verifier is None and get_pin_hash(pin) != pin_hash:
+                return False
+            debug("Session: Deriving the key")
+            session = Session(pin_hash, salt, pin, self.session_timeout)
+            if verifier is not None and not check_verifier(session.key, verifier):
+                return False
+            self.session = session
+        return self.session.key
+
+    def _cipher(self, key: bytes) -> "Fernet":
+        """:returns: The cipher for the key, reusing the one of the session"""
+        if self.session and self.session.key == key:
+            return self.session.cipher
+        from cryptography.fernet import Fernet
+        return Fernet(key)
+
+    def register(self, filename: str, pin: bytes, candidates: dict, profile: str = default_profile) -> bytes:
         """Registers the candidates.
         It stores the candidate list in a file.
 
         :param filename: The filename of the file in which the data is stored
         :param pin: The pin to be stored
         :param candidates: A dict containing the candidate details
+        :param profile: The redundancy profile used for the vote files (see codec.profiles)
         :returns: The candidate list
         """
+        self.logout()
+        if profile not in profiles:
+            self.error_handler(ValueError("Unknown redundancy profile: " + profile))
+            profile = default_profile
         for key in candidates:
             candidates[key] = tuple(candidates[key])
-        candidates[pin_key] = get_pin_hash(pin)
+        # Only a verifier derived from the key is stored, since a plain hash of the PIN could be guessed quickly
+        salt = urandom(salt_size)
+        session = Session(None, salt, pin, self.session_timeout)
+        candidates[profile_key] = profile
+        candidates[salt_key] = salt
+        candidates[verifier_key] = pin_verifier(session.key)
         try:
-            with open(path(True, filename), "wb") as file:
-                pickle.dump(candidates, file)
+            stage("file_write", write_atomic, path(True, filename), stage("pickle", pickle.dumps, candidates))
         except Exception as e:
             self.error_handler(e)
+        self.vote_file_name = filename
+        self._ensure_shard_dir()
         self.candidates = candidates
+        self.registry = CandidateRegistry(candidates)
+        self._boards_version = None
+        self._codec = get_codec(profiles[profile], self.workers)
+        self.session = session
         return candidates
 
     def read_candidates(self, filename: str) -> dict:
@@ -80,64 +330,686 @@ class Backend:
         :param filename: The file name of the candidate list
         :returns: The the loaded data
         """
+        self.logout()
         self.vote_file_name = filename
+        self._ensure_shard_dir()
         try:
             with open(path(True, filename), "rb") as file:
-                candidates = pickle.load(file)
+                candidates = stage("unpickle", pickle.load, file)
                 self.candidates = candidates
+                self.registry = CandidateRegistry(candidates)
+                self._boards_version = None
+                self._codec = get_codec(profiles[self.registry.profile or default_profile], self.workers)
                 return candidates
         except Exception as e:
             self.error_handler(e)
             return {}
 
+    @property
+    def _sync(self) -> bool:
+        """Whether writes have to wait until the data is safely on the disk"""
+        return self.durability != "none"
+
+    def _ensure_shard_dir(self):
+        """Creates the folder holding the shards of the election, if this Backend writes to one"""
+        if self.shard is not None and not ensure_dir(vote_path + self.vote_file_name):
+            debug("Shard path created")
+
     def store_votes(self, pin: str, votes: list) -> bool:
         """Stores the list of vote data
         It iterates through votes, which should 
         contain the vote data generated by get_vote()
         The encrypted data is stored in a file in vote_path
         with its name being the encryption key. Just for fun.
+        In journal mode, the votes are appended to the journal instead.
 
         :param pin: The PIN used to encrypt the vote file
         :param votes: A list of vote data
         :returns: Whether the votes were stored successfully?
         """
         debug(votes)
-        key = get_key(self.candidates[pin_key], pin)
+        report = self.store_votes_many(pin, [votes])
+        return bool(report) and not report[0]["rejected"]
+
+    def store_votes_many(self, pin: str, ballots, batch_size: int = 0):
+        """Stores many ballots with a single decrypt/encrypt cycle per batch
+        ballots can be any iterable (such as a generator) of the vote data
+        generated by get_vote(). Only the counts are kept in memory,
+        so the ballots are never all loaded at once.
+        A ballot with an unknown candidate is skipped as a whole and passed to the error handler.
+
+        :param pin: The PIN used to encrypt the vote file
+        :param ballots: An iterable of vote data (candidate IDs or hashes)
+        :param batch_size: The number of ballots stored per batch (0 stores them all in one batch)
+        :returns: A list with the number of ballots stored and rejected and the time taken (in seconds) for each batch,
+                  or False if the PIN is wrong or a batch couldn't be written
+        """
+        key = self._get_key(pin)
         if not key:
             self.error_handler(PinException)
             return False
-        if isfile(path(False, self.vote_file_name)):
-            with open(path(False, self.vote_file_name), "rb") as file:
-                debug("Store: Vote data found.")
-                data = self.decrypt(key, file.read())
-        else:
-            debug("Store: Vote data not found. Creating new file.")
-            data = {}
-        for vote in votes:
-            if vote in data:
-                data[vote] += 1
-            else:
-                data[vote] = 1
-        debug(data)
+        report = []
+        ballots = iter(ballots)
+        to_id, digests = self.registry.to_id, self.registry.digests
+        size = len(digests)
+        while True:
+            start = perf_counter()
+            counts = [0] * size
+            stored = rejected = 0
+            for votes in islice(ballots, batch_size or None):
+                try:
+                    # Candidate IDs in range are taken as they are, anything else is checked by to_id
+                    ids = [vote if type(vote) is int and 0 <= vote < size else to_id(vote) for vote in votes]
+                except (IndexError, KeyError, TypeError):
+                    self.error_handler(ValueError("Invalid ballot: " + repr(votes)))
+                    rejected += 1
+                    continue
+                for candidate in ids:
+                    counts[candidate] += 1
+                stored += 1
+            if not stored and not rejected:
+                break
+            counts = {digests[i]: count for i, count in enumerate(counts) if count}
+            if stored and not self._store_counts(key, counts, stored):
+                return False
+            report.append({"ballots": stored, "rejected": rejected, "seconds": perf_counter() - start})
+            debug("Store: Batch stored: %s", report[-1])
+        return report
 
-        with open(path(False, self.vote_file_name), "wb") as file:
-            file.write(self.encrypt(key, data))
-        return True
+    def import_ballots(self, pin: str, filename: str, format: str = None, batch_size: int = 10000):
+        """Imports ballots from a CSV or JSONL file (see importer.py)
+        The file is streamed, so only one batch of ballots is in memory at a time.
+        Rows that aren't valid ballots are skipped and reported, without stopping the import.
+        If the import stops early (for example, if the file can't be read any more), the batches
+        stored so far stay stored, and the report says how many ballots they hold.
+
+        :param pin: The PIN used to encrypt the vote file
+        :param filename: The path of the file
+        :param format: The format of the file (see importer.import_formats), guessed from the extension by default
+        :param batch_size: The number of ballots stored per batch
+        :returns: A report with the number of rows, stored and rejected ballots, the speed and the error
+                  that stopped the import (None if it finished), or False if nothing could be imported
+        """
+        if not self._get_key(pin):
+            self.error_handler(PinException)
+            return False
+        start = perf_counter()
+        importer = BallotImporter(self.registry)
+        batches, error = [], None
+        try:
+            format = format or guess_format(filename)
+            with open_ballots(filename) as file:
+                ballots = importer.ballots(read_rows(file, format))
+                while True:
+                    batch = self.store_votes_many(pin, islice(ballots, batch_size or None))
+                    if batch is False:
+                        raise ImportException("The ballots couldn't be stored")
+                    if not batch:
+                        break
+                    batches.extend(batch)
+        except (OSError, ImportException, csv.Error) as e:
+            self.error_handler(e)
+            if not batches:
+                return False
+            error = str(e)
+        seconds = perf_counter() - start
+        return {"rows": importer.rows, "stored": sum(batch["ballots"] for batch in batches),
+                "rejected": importer.rejected, "rejections": importer.rejections, "batches": len(batches),
+                "seconds": seconds, "rows_per_second": importer.rows / seconds if seconds else 0.0, "error": error}
+
+    def store_ranked(self, pin: str, ballots, batch_size: int = 0) -> bool:
+        """Stores ranked ballots, for the tally engines of engines.py
+        Each ballot holds, for each category, the candidate IDs in order of preference
+        (an empty ranking skips the category). They are appended to the ranked ballot file,
+        one record per batch, and are not added to the counts of store_votes.
+
+        :param pin: The PIN used to encrypt the vote file
+        :param ballots: An iterable of ranked ballots, such as the ones from get_vote(ranked=True)
+        :param batch_size: The number of ballots stored per record (0 stores them all in one record)
+        :returns: Whether the ballots were stored successfully?
+        """
+        from engines import ballot_matrix
+        key = self._get_key(pin)
+        if not key:
+            self.error_handler(PinException)
+            return False
+        ranges = self.registry.ranges
+        ballots = iter(ballots)
+        try:
+            self._ranked_matrices(key, self.file_name)
+            while True:
+                rankings, stored = [[] for ids in ranges], 0
+                for ballot in islice(ballots, batch_size or None):
+                    if len(ballot) != len(ranges):
+                        raise ValueError("A ranked ballot needs a ranking for each category")
+                    for cat_rankings, ranking, ids in zip(rankings, ballot, ranges):
+                        if len(set(ranking)) != len(ranking) or any(type(c) is not int or c not in ids for c in ranking):
+                            raise ValueError("Invalid ranking: " + str(ranking))
+                        cat_rankings.append([candidate - ids.start for candidate in ranking])
+                    stored += 1
+                if not stored:
+                    return True
+                with self._write_lock():
+                    self._ranked_matrices(key, self.file_name)  # Records another Backend appended aren't mistaken for a cut one
+                    self._append_ranked(key, [ballot_matrix(cat_rankings, len(ids)) for cat_rankings, ids in zip(rankings, ranges)])
+                debug("Store: %d ranked ballots stored", stored)
+        except Exception as e:
+            self.error_handler(e)
+            return False
+
+    def read_ranked(self, pin: str) -> list:
+        """Reads the ranked ballots of the election, from every shard
+        Only the records written since the last read are decrypted.
+
+        :param pin: The PIN used to encrypt the vote data
+        :returns: The ballot matrix of each category (see engines.py)
+        """
+        from engines import join_matrices
+        key = self._get_key(pin)
+        if not key:
+            self.error_handler(PinException)
+            return False
+        parts = [[] for ids in self.registry.ranges]
+        try:
+            for name in [self.file_name] + self._shard_names():
+                for cat_parts, matrices in zip(parts, self._ranked_matrices(key, name)):
+                    cat_parts.extend(matrices)
+        except Exception as e:
+            self.error_handler(e)
+            return False
+        return [join_matrices(cat_parts, len(ids)) for cat_parts, ids in zip(parts, self.registry.ranges)]
+
+    def tally(self, pin: str, method: str = "irv") -> list:
+        """Counts the ranked ballots with one of the tally engines
+
+        :param pin: The PIN used to encrypt the vote data
+        :param method: The name of the engine (see engines.tally_engines)
+        :returns: The result of each category, indexed by category ID
+        """
+        from engines import tally_engines
+        if method not in tally_engines:
+            self.error_handler(ValueError("Unknown tally method: " + method))
+            return False
+        matrices = self.read_ranked(pin)
+        if matrices is False:
+            return False
+        return [tally_engines[method].tally(matrix, names) for matrix, names in zip(matrices, self.registry.names)]
 
     def read_votes(self, pin: str) -> dict:
         """Reads and displays the data from a vote file
+        In journal mode, the records in the journal are added to the vote file data.
+        The data is kept in memory, and only read again if the files change.
         
         :param pin: The PIN used to encrypt the vote data
         :returns: The vote data
         """
-        key = get_key(self.candidates[pin_key], pin)
+        key = self._get_key(pin)
+        if not key:
+            self.error_handler(PinException)
+            return False
+        data = dict(self._merged(key))
+        data.pop(seq_key, None)
+        debug("Read: Votes found: %s", data)
+        return data
+
+    def read_counts(self, pin: str) -> list:
+        """Reads the number of votes of each candidate
+
+        :param pin: The PIN used to encrypt the vote data
+        :returns: The number of votes, indexed by candidate ID
+        """
+        key = self._get_key(pin)
         if not key:
             self.error_handler(PinException)
             return False
-        if isfile(path(False, self.vote_file_name)):
-            data = self.decrypt(key, open(path(False, self.vote_file_name), "rb").read())
-            debug("Read: Votes found: " + str(data))
+        votes = self._merged(key)
+        return [votes.get(digest, 0) for digest in self.registry.digests]
+
+    def leaderboards(self, pin: str) -> list:
+        """Gets the ranking of each category (see leaderboard.py)
+        The leaderboards are updated as ballots are stored, and only
+        built again from the counts if the vote files were changed by someone else.
+
+        :param pin: The PIN used to encrypt the vote data
+        :returns: The leaderboards, indexed by category ID
+        """
+        key = self._get_key(pin)
+        if not key:
+            self.error_handler(PinException)
+            return False
+        votes = self._merged(key)
+        if self._boards_version != self.tally_version:
+            debug("Leaderboards: Building the leaderboards")
+            registry = self.registry
+            counts = [votes.get(digest, 0) for digest in registry.digests]
+            self._boards = [Leaderboard(cat, registry.names[cat_id], counts[ids.start:ids.stop])
+                            for cat_id, (cat, ids) in enumerate(zip(registry.categories, registry.ranges))]
+            self._boards_version = self.tally_version
+        return self._boards
+
+    def compact(self, pin: str) -> bool:
+        """Folds the journal into the vote file
+        The vote file remembers the sequence number of the last record folded into it,
+        so a crash before the journal is removed can't count a record twice.
+
+        :param pin: The PIN used to encrypt the vote data
+        :returns: Whether the journal was compacted successfully?
+        """
+        key = self._get_key(pin)
+        if not key:
+            self.error_handler(PinException)
+            return False
+        with self._lock:
+            if not self.flush():
+                return False
+            if not self.journal:
+                return True
+            with self._write_lock():
+                compacted = self._compact(key)
+                self._signature = self._file_signature()  # Before another Backend can write the files again
+            return compacted
+
+    def flush(self) -> bool:
+        """Writes the votes kept in memory to the vote file (or the journal)
+
+        :returns: Whether the votes were stored successfully?
+        """
+        with self._lock:
+            if self._flush_timer:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if not self._pending_ballots:
+                return True
+            key = self._cache_key
+            with self._write_lock():
+                self._refresh(key)
+                debug("Flush: Writing %d ballots", self._pending_ballots)
+                if self.journal:
+                    stored = self._append_counts(key, self._pending)
+                elif self.slotted:
+                    ids = self.registry.ids
+                    self._slot_file(key).add({ids[vote]: self._pending[vote] for vote in self._pending}, self._sync)
+                    stored = True
+                else:
+                    stage("file_write", write_atomic, path(False, self.file_name),
+                          stage_pieces("file_write", self._encrypt_pieces(key, self._votes)), self._sync)
+                    stored = True
+                self._signature = self._file_signature()  # Before another Backend can write the files again
+            self._pending, self._pending_ballots = {}, 0
+            self._flushed_at = perf_counter()
+            return stored
+
+    def _timed_flush(self):
+        """Flushes the votes kept in memory when the timer goes off (see _store_counts)"""
+        try:
+            self.flush()
+        except Exception as e:
+            self.error_handler(e)
+
+    def close(self) -> bool:
+        """Flushes the votes kept in memory and empties the cache.
+        Call it before the program exits.
+
+        :returns: Whether the votes were stored successfully?
+        """
+        with self._lock:
+            stored = self.flush()
+            if self._slots:
+                self._slots.close()
+            self._votes = self._cache_key = self._signature = self._slots = self._slots_key = None
+            self._shards = {}
+            self._ranked = {}
+            return stored
+
+    def memory_usage(self) -> int:
+        """Estimates the memory used by the election data kept in memory:
+        the candidate registry, the vote data (with the other shards), the leaderboards and the ranked ballots
+
+        :returns: The estimate, in bytes
+        """
+        entries = len(self._votes or ()) + sum(len(votes) for signature, votes in self._shards.values())
+        ranked = sum(matrix.nbytes for cached in self._ranked.values() for parts in cached[2] for matrix in parts)
+        return election_footprint + len(self.registry) * candidate_footprint + entries * vote_footprint + ranked
+
+    def _file_signature(self, name: str = None) -> tuple:
+        """Gets the modification time, size and inode of the vote files, to notice changes
+        Vote files are replaced rather than written in place, and every write of one has the same size,
+        so the inode tells two writes apart even when the modification time can't.
+
+        :param name: The file name (with the shard, if any), this Backend's own by default
+        :returns: The file name, and the modification time, size and inode of each file
+        """
+        name = name or self.file_name
+        signature = [name]
+        for name in (path(False, name), log_path(name), slots_path(name)):
+            try:
+                info = stat(name)
+                signature.append((info.st_mtime_ns, info.st_size, info.st_ino))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def _refresh(self, key: bytes) -> dict:
+        """Makes sure the vote data kept in memory matches the files on disk
+        If the files were changed by someone else, they are read again and
+        the votes not written to disk yet are added to them.
+
+        :param key: The encryption key
+        :returns: The vote data kept in memory
+        """
+        with self._lock:
+            signature = self._file_signature()
+            if self._votes is not None and key == self._cache_key and signature == self._signature:
+                return self._votes
+            debug("Cache: Reading the vote data")
+            self.tally_version += 1
+            self._votes = self._load_votes(key)
+            for vote in self._pending:
+                self._votes[vote] = self._votes.get(vote, 0) + self._pending[vote]
+            self._cache_key, self._signature = key, signature
+            return self._votes
+
+    def _load_votes(self, key: bytes) -> dict:
+        """Rebuilds the vote data from the vote files of this Backend (or its shard)
+
+        :param key: The encryption key
+        :returns: The vote data, including its sequence number
+        """
+        data, count = self._read_files(key, self.file_name)
+        self._journal_state = ((self.file_name, self._log_size()), data[seq_key], count)
+        return data
+
+    def _read_files(self, key: bytes, name: str) -> tuple:
+        """Reads the vote data stored under a file name: the vote file,
+        with its journal folded in, and the slotted file
+
+        :param key: The encryption key
+        :param name: The file name (with the shard, if any)
+        :returns: The vote data with its sequence number, and the number of journal records read
+        """
+        own = name == self.file_name
+        if isfile(path(False, name)):
+            with open(path(False, name), "rb") as file:
+                data = self._decrypt_file(key, file)
         else:
             debug("Read: Votes not found")
             data = {}
+        seq = data.get(seq_key, 0)
+        count = 0
+        # Only a journal this Backend writes to is repaired: any other may be in the middle of a write
+        for record in self._read_journal(key, name, own and self.journal):
+            # Records already folded into the vote file are skipped
+            if record.get(seq_key, 0) <= seq:
+                continue
+            seq = record.pop(seq_key)
+            count += 1
+            for vote in record:
+                data[vote] = data.get(vote, 0) + record[vote]
+        data[seq_key] = seq
+
+        if (own and self.slotted) or isfile(slots_path(name)):
+            slots = None
+            try:
+                if own and self.slotted:
+                    counts = self._slot_file(key).read_counts()
+                else:
+                    slots = SlottedFile(slots_path(name), self.registry.digests, self._codec.nsym, self._cipher(key))
+                    counts = slots.read_counts()
+            except Exception as e:
+                self.error_handler(e)
+                counts = []
+            finally:
+                if slots:
+                    slots.close()
+            for digest, votes in zip(self.registry.digests, counts):
+                if votes:
+                    data[digest] = data.get(digest, 0) + votes
+        return data, count
+
+    def _shard_names(self) -> list:
+        """Lists the file names of the other vote files of the election:
+        the unsharded vote file and every shard (see the shard parameter)
+
+        :returns: The file names, without this Backend's own
+        """
+        names = [self.vote_file_name]
+        folder = vote_path + self.vote_file_name
+        if isdir(folder):
+            shards = {splitext(file)[0] for file in listdir(folder) if splitext(file)[1] in vote_extensions}
+            names.extend(self.vote_file_name + "/" + shard for shard in sorted(shards))
+        return [name for name in names if name != self.file_name]
+
+    def _merged(self, key: bytes) -> dict:
+        """Adds up the vote data of this Backend and of the other shards of the election
+        The other shards are only read again when their files change.
+
+        :param key: The encryption key
+        :returns: The vote data of the whole election
+        """
+        data = self._refresh(key)
+        shards = {}
+        for name in self._shard_names():
+            signature = self._file_signature(name)
+            if not any(signature[1:]):
+                continue
+            cached = self._shards.get(name)
+            if cached is None or cached[0] != (key, signature):
+                debug("Read: Reading shard %s", name)
+                self.tally_version += 1
+                cached = ((key, signature), self._read_files(key, name)[0])
+            shards[name] = cached
+        if shards.keys() != self._shards.keys():
+            self.tally_version += 1
+        self._shards = shards
+        if not shards:
+            return data
+        data = dict(data)
+        for signature, votes in shards.values():
+            for vote in votes:
+                if vote != seq_key:
+                    data[vote] = data.get(vote, 0) + votes[vote]
         return data
+
+    def _slot_file(self, key: bytes) -> SlottedFile:
+        """Opens the slotted file of the current election, creating it if needed
+
+        :param key: The encryption key
+        :returns: The slotted file
+        """
+        if self._slots is None or key != self._slots_key:
+            if self._slots:
+                self._slots.close()
+            self._slots = SlottedFile(slots_path(self.file_name), self.registry.digests, self._codec.nsym, self._cipher(key))
+            self._slots_key = key
+        return self._slots
+
+    def _read_journal(self, key: bytes, name: str, repair: bool = True) -> list:
+        """Reads the records of a journal
+        A record cut short by a crash is removed from the end of the journal
+        (a record with a damaged length prefix is still read, see record_spans).
+
+        :param key: The encryption key
+        :param name: The file name (with the shard, if any)
+        :param repair: Whether to remove an incomplete record at the end
+        :returns: The decrypted records, in the order they were written
+        """
+        name = log_path(name)
+        if not isfile(name):
+            return []
+        with open(name, "rb") as file:
+            spans, offset = self._record_spans(file)
+            records = [self._decrypt_file(key, file, start, end - start) for start, end in spans]
+            length = fstat(file.fileno()).st_size
+        if offset < length and repair:
+            with self._write_lock(), open(name, "r+b") as file:
+                # The record may have been finished since by another Backend, which held the lock while writing it
+                offset = self._record_spans(file, offset)[1]
+                if offset < fstat(file.fileno()).st_size:
+                    self.error_handler(JournalException("Incomplete journal record removed"))
+                    file.truncate(offset)
+        return records
+
+    def _record_spans(self, file, offset: int = 0) -> tuple:
+        """Finds the complete records of a journal or ranked ballot file, reading only their prefixes
+        (see record_spans)
+
+        :param file: The file, open for reading in binary mode
+        :param offset: The position of the first record
+        :returns: The (start, end) position of the data of each record, up to the first one cut short,
+                  and the position where the complete records end
+        """
+        def read(position: int, size: int) -> bytes:
+            file.seek(position)
+            return file.read(size)
+        spans, complete = record_spans(read, fstat(file.fileno()).st_size, offset)
+        return [(start, end) for prefix, start, end in spans], complete
+
+    def _ranked_matrices(self, key: bytes, name: str) -> list:
+        """Brings the ranked ballots kept in memory for a file up to date,
+        decrypting only the records written since it was last read
+
+        :param key: The encryption key
+        :param name: The file name (with the shard, if any)
+        :returns: The matrices of each category, one per record (joined when read)
+        """
+        from engines import unpack_ranked, join_matrices
+        sizes = [len(ids) for ids in self.registry.ranges]
+        filename = ranked_path(name)
+        size = getsize(filename) if isfile(filename) else 0
+        cached = self._ranked.get(name)
+        if cached is None or cached[0] != key or size < cached[1]:
+            cached = self._ranked[name] = [key, 0, [[] for ids in sizes]]
+        if size > cached[1]:
+            with open(filename, "rb") as file:
+                for start, end in self._record_spans(file, cached[1])[0]:
+                    matrices = unpack_ranked(self._unseal_file(key, file, start, end - start), sizes)
+                    for parts, matrix in zip(cached[2], matrices):
+                        parts.append(matrix)
+                    cached[1] = end
+            for parts, candidates in zip(cached[2], sizes):
+                if len(parts) > 1:
+                    parts[:] = [join_matrices(parts, candidates)]
+        return cached[2]
+
+    def _append_ranked(self, key: bytes, matrices: list):
+        """Appends a record of ranked ballots to the ranked ballot file
+
+        :param key: The encryption key
+        :param matrices: The ballot matrix of each category
+        """
+        from engines import pack_ranked
+        filename = ranked_path(self.file_name)
+        cached = self._ranked[self.file_name]
+        if isfile(filename) and getsize(filename) > cached[1]:
+            # A record cut short would hide the records written after it
+            self.error_handler(JournalException("Incomplete ranked ballot record removed"))
+            with open(filename, "r+b") as file:
+                file.truncate(cached[1])
+        record = pack_record(self._seal(key, pack_ranked(matrices, [len(ids) for ids in self.registry.ranges])))
+        with open(filename, "ab") as file:
+            stage("file_write", file.write, record)
+            if self._sync:
+                file.flush()
+                fsync(file.fileno())
+        for parts, matrix in zip(cached[2], matrices):
+            parts.append(matrix)
+        cached[1] += len(record)
+
+    def _log_size(self) -> int:
+        """:returns: The size of the journal of the current election"""
+        name = log_path(self.file_name)
+        return getsize(name) if isfile(name) else 0
+
+    def _store_counts(self, key: bytes, counts: dict, ballots: int) -> bool:
+        """Adds the vote counts to the vote data kept in memory,
+        and writes them to disk when the flush policy says so
+
+        :param key: The encryption key
+        :param counts: The number of votes for each candidate
+        :param ballots: The number of ballots the votes came from
+        :returns: Whether the votes were stored successfully?
+        """
+        with self._lock:
+            votes = self._refresh(key)
+            for vote in counts:
+                votes[vote] = votes.get(vote, 0) + counts[vote]
+                self._pending[vote] = self._pending.get(vote, 0) + counts[vote]
+            self._pending_ballots += ballots
+            if self._boards_version == self.tally_version:
+                self._update_boards(counts)
+                self._boards_version += 1
+            self.tally_version += 1
+            debug(votes)
+
+            if self.durability == "every-ballot":
+                return self.flush()
+            if self.durability == "batched":
+                # Group commit: everything stored within the window shares one write and fsync
+                window = self.commit_window
+            else:
+                if self.flush_every and self._pending_ballots >= self.flush_every:
+                    return self.flush()
+                window = self.flush_interval
+            if not window:
+                return True
+            elapsed = (perf_counter() - self._flushed_at) * 1000
+            if elapsed >= window:
+                return self.flush()
+            if self._flush_timer is None:
+                # The window is also ended by a timer, in case no other ballot comes
+                self._flush_timer = threading.Timer((window - elapsed) / 1000, self._timed_flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+            return True
+
+    def _update_boards(self, counts: dict):
+        """Adds the vote counts to the leaderboards
+
+        :param counts: The number of votes for each candidate
+        """
+        registry = self.registry
+        for vote in counts:
+            candidate = registry.ids[vote]
+            cat_id = registry.category_ids[candidate]
+            self._boards[cat_id].add(candidate - registry.ranges[cat_id].start, counts[vote])
+
+    def _append_counts(self, key: bytes, counts: dict) -> bool:
+        """Appends the vote counts to the journal as a single record
+
+        :param key: The encryption key
+        :param counts: The number of votes for each candidate
+        :returns: Whether the votes were stored successfully?
+        """
+        state = self._journal_state
+        if state is None or state[0] != (self.file_name, self._log_size()):
+            debug("Store: Journal changed. Reading it again.")
+            self._load_votes(key)
+            state = self._journal_state
+        seq, count = state[1] + 1, state[2] + 1
+        record = dict(counts)
+        record[seq_key] = seq
+        blob = self.encrypt(key, record)
+        with open(log_path(self.file_name), "ab") as file:
+            stage("file_write", file.write, pack_record(blob))
+            if self._sync:
+                file.flush()
+                fsync(file.fileno())
+        self._journal_state = ((self.file_name, self._log_size()), seq, count)
+        if count >= self.compact_every:
+            return self._compact(key)
+        return True
+
+    def _compact(self, key: bytes) -> bool:
+        """Writes the vote data with the journal folded in and removes the journal
+
+        :param key: The encryption key
+        :returns: Whether the journal was compacted successfully?
+        """
+        data = self._load_votes(key)
+        debug("Compact: Folding the journal up to record %d", data[seq_key])
+        stage("file_write", write_atomic, path(False, self.file_name),
+              stage_pieces("file_write", self._encrypt_pieces(key, data)), self._sync)
+        if isfile(log_path(self.file_name)):
+            remove(log_path(self.file_name))
+        self._journal_state = ((self.file_name, 0), data[seq_key], 0)
+        return True
@@ -0,0 +1,237 @@
+"""
+Benchmarks for the storage, encryption and error correction of the Backend
+
+Generates a synthetic election, then times each stage of the pipeline
+(reading the candidate list, encrypting and decrypting the vote data,
+RS encoding and decoding, reading the votes) and storing ballots end to end.
+Everything runs in a temporary directory, so existing elections aren't touched.
+
+Usage:
+    python benchmark.py [--categories 5] [--candidates 10] [--ballots 10000] [--output results.json]
+
+The results can be written as JSON (see --output), to compare runs across commits.
+"""
+
+import sys
+import json
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+from time import time
+from utils import *
+from backend import *
+
+
+bench_pin = b"1234"
+repo_path = dirname(os.path.abspath(__file__))
+# A short run that only reads the results, like viewing them from the command line
+read_script = ("from backend import Backend; backend = Backend(print); backend.read_candidates('bench'); "
+               "backend.read_counts({!r})").format(bench_pin)
+
+
+def synthetic_election(categories: int, candidates: int) -> dict:
+    """Generates a candidate dict
+
+    :param categories: The number of categories
+    :param candidates: The number of candidates in each category
+    :returns: The candidate dict, as passed to Backend.register
+    """
+    return {f"Category {cat}": [f"Candidate {cat}-{i}" for i in range(candidates)] for cat in range(categories)}
+
+
+def synthetic_ballots(registry, ballots: int, seed: int = 0):
+    """Generates random ballots
+
+    :param registry: The CandidateRegistry of the election
+    :param ballots: The number of ballots
+    :param seed: The random seed, so runs can be compared
+    :returns: A generator of ballots (tuples of candidate IDs)
+    """
+    rng = random.Random(seed)
+    ranges = registry.ranges
+    for i in range(ballots):
+        yield tuple(rng.choice(ids) for ids in ranges)
+
+
+def measure(function, repeat: int) -> list:
+    """Runs a function several times
+
+    :param function: The function, called without arguments
+    :param repeat: The number of runs
+    :returns: The time taken by each run (in seconds)
+    """
+    times = []
+    for i in range(repeat):
+        start = perf_counter()
+        function()
+        times.append(perf_counter() - start)
+    return times
+
+
+def summarize(times: list, items: int = 1, size: int = 0) -> dict:
+    """Works out the statistics of a stage
+
+    :param times: The time taken by each run (in seconds)
+    :param items: The number of items (such as ballots) handled by each run
+    :param size: The number of bytes handled by each run
+    :returns: The throughput and the latency percentiles (in milliseconds)
+    """
+    ordered = sorted(times)
+    percentile = lambda p: ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000
+    total = sum(times)
+    result = {"runs": len(times), "items_per_second": items * len(times) / total if total else 0.0,
+              "mean_ms": total / len(times) * 1000, "p50_ms": percentile(50), "p90_ms": percentile(90),
+              "p99_ms": percentile(99), "max_ms": ordered[-1] * 1000}
+    if size:
+        result["megabytes_per_second"] = size * len(times) / total / 1e6 if total else 0.0
+    return result
+
+
+def measure_startup(arguments: list, repeat: int) -> list:
+    """Runs a new Python process several times, in the current directory
+
+    :param arguments: The arguments of the Python interpreter
+    :param repeat: The number of runs
+    :returns: The time taken by each run (in seconds)
+    """
+    env = dict(os.environ, PYTHONPATH=repo_path)
+    run = lambda: subprocess.run([sys.executable] + arguments, env=env, check=True,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return measure(run, repeat)
+
+
+def git_commit() -> str:
+    """:returns: The current git commit, or None outside of a git checkout"""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=repo_path).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(categories: int, candidates: int, ballots: int, repeat: int, batch_size: int) -> dict:
+    """Runs every benchmark in the current directory
+
+    :param categories: The number of categories of the election
+    :param candidates: The number of candidates in each category
+    :param ballots: The number of ballots stored
+    :param repeat: The number of runs of the stages that don't depend on the ballots
+    :param batch_size: The number of ballots stored per batch in the bulk storage benchmark
+    :returns: The statistics of each stage
+    """
+    errors = []
+    backend = Backend(errors.append, flush_every=1)
+    backend.register("bench", bench_pin, synthetic_election(categories, candidates))
+    backend.open_session(bench_pin)
+    key = backend._get_key(bench_pin)
+    stages = {}
+
+    stages["read_candidates"] = summarize(measure(lambda: backend.read_candidates("bench"), repeat))
+    backend.open_session(bench_pin)
+
+    # A vote file with every candidate voted for, so the payload has its full size
+    data = {digest: ballots for digest in backend.registry.digests}
+    encrypted = backend.encrypt(key, data)
+    plain = seal(key, pack_tally(data, backend.registry.digests))  # The container, as it is RS encoded
+    encoded = backend._codec.encode(plain)
+    stages["encrypt"] = summarize(measure(lambda: backend.encrypt(key, data), repeat), size=len(encrypted))
+    stages["decrypt"] = summarize(measure(lambda: backend.decrypt(key, encrypted), repeat), size=len(encrypted))
+    stages["rs_encode"] = summarize(measure(lambda: backend._codec.encode(plain), repeat), size=len(plain))
+    stages["rs_decode"] = summarize(measure(lambda: backend._codec.decode(encoded), repeat), size=len(encoded))
+    damaged = bytearray(encoded)
+    rng = random.Random(0)
+    for chunk in range(0, len(damaged), backend._codec.nsize):
+        for i in range(min(8, len(damaged) - chunk)):
+            damaged[chunk + rng.randrange(min(backend._codec.nsize, len(damaged) - chunk))] ^= 0xff
+    stages["rs_decode_damaged"] = summarize(measure(lambda: backend._codec.decode(damaged), repeat), size=len(damaged))
+    # With the digest table written in the header, clean chunks skip the syndromes and damaged ones are erasures
+    digests = backend._codec.digests(encoded)
+    stages["rs_decode_digests"] = summarize(measure(lambda: backend._codec.decode(encoded, digests=digests), repeat),
+                                            size=len(encoded))
+    stages["rs_repair_digests"] = summarize(measure(lambda: backend._codec.decode(damaged, digests=digests), repeat),
+                                            size=len(damaged))
+
+    # End to end: one ballot at a time, each written to disk
+    single = synthetic_ballots(backend.registry, min(ballots, 1000), seed=1)
+    stages["store_votes"] = summarize(measure(lambda: backend.store_votes(bench_pin, next(single)), min(ballots, 1000)))
+
+    # End to end: every ballot, in batches
+    start = perf_counter()
+    report = backend.store_votes_many(bench_pin, synthetic_ballots(backend.registry, ballots, seed=2), batch_size)
+    total = perf_counter() - start
+    stages["store_votes_many"] = summarize([batch["seconds"] for batch in report], batch_size or ballots)
+    stages["store_votes_many"]["items_per_second"] = ballots / total if total else 0.0
+
+    stages["read_votes_cached"] = summarize(measure(lambda: backend.read_votes(bench_pin), repeat))
+    reader = Backend(errors.append)
+    reader.read_candidates("bench")
+    reader.open_session(bench_pin)
+
+    def read_cold():
+        reader._votes = None  # Forgets the cached vote data, so the vote file is read and decoded again
+        reader.read_votes(bench_pin)
+    stages["read_votes_cold"] = summarize(measure(read_cold, repeat))
+    backend.close()
+
+    # Starting up, without the codec tables cache and then with it
+    startup_runs = max(1, min(repeat, 10))
+    stages["startup_help"] = summarize(measure_startup([os.path.join(repo_path, "main.py"), "--help"], startup_runs))
+    uncached = []
+    for i in range(startup_runs):
+        if isfile(table_cache):
+            remove(table_cache)
+        uncached += measure_startup(["-c", read_script], 1)
+    stages["startup_read_uncached"] = summarize(uncached)
+    stages["startup_read"] = summarize(measure_startup(["-c", read_script], startup_runs))
+    if errors:
+        raise errors[0]
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the Backend with a synthetic election")
+    parser.add_argument("--categories", type=int, default=5)
+    parser.add_argument("--candidates", type=int, default=10, help="the number of candidates in each category")
+    parser.add_argument("--ballots", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=50, help="the number of runs of each stage")
+    parser.add_argument("--batch-size", type=int, default=1000, help="the number of ballots stored at once")
+    parser.add_argument("--instrument", action="store_true",
+                        help="also time each stage inside the Backend (see utils.stage), at a small cost")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    cwd = os.getcwd()
+    instrument(args.instrument)
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            stages = run(args.categories, args.candidates, args.ballots, args.repeat, args.batch_size)
+        finally:
+            os.chdir(cwd)
+
+    print(f"{'Stage':<20}{'items/s':>12}{'MB/s':>9}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}")
+    for name, stage in stages.items():
+        mbps = f"{stage['megabytes_per_second']:.1f}" if "megabytes_per_second" in stage else "-"
+        print(f"{name:<20}{stage['items_per_second']:>12.0f}{mbps:>9}"
+              f"{stage['p50_ms']:>10.3f}{stage['p90_ms']:>10.3f}{stage['p99_ms']:>10.3f}")
+
+    if args.instrument:
+        print(f"\n{'Backend stage':<20}{'calls':>8}{'mean ms':>10}{'bytes in':>14}{'bytes out':>14}")
+        for name, stats in sorted(stage_report().items()):
+            print(f"{name:<20}{stats['calls']:>8}{stats['mean_ms']:>10.3f}{stats['bytes_in']:>14}{stats['bytes_out']:>14}")
+
+    if output:
+        results = {"commit": git_commit(), "time": time(), "python": platform.python_version(),
+                   "platform": platform.platform(), "parameters": vars(args), "stages": stages}
+        if args.instrument:
+            results["instrumentation"] = stage_report()
+        with open(output, "w") as file:
+            json.dump(results, file, indent=2)
+        print("Results written to", output)
+
+
+if __name__ == "__main__":
+    main()
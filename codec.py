@@ -0,0 +1,771 @@
+"""
+Vectorized Reed-Solomon codec for the vote files
+
+The codec produces exactly the same bytes as reedsolo's RSCodec,
+so files written by either one can be read by the other.
+Instead of encoding the message one chunk and one byte at a time,
+every chunk is encoded at once with NumPy, using a precomputed
+GF(2^8) multiplication table. Decoding computes the syndromes of every
+chunk at once too, and only runs the (much slower) error correction
+on the chunks that actually have errors.
+
+Each vote file starts with a small header recording the number of ECC
+symbols it was encoded with, so that the redundancy can be chosen per
+election. Files without the header are legacy files encoded with RSCodec(160).
+
+Since the chunks are independent, large files can also be split on chunk
+boundaries and encoded or decoded by several processes at once (ParallelRSCodec).
+
+Version 2 headers are followed by a table of CRC32 digests (the low 16 bits)
+of each 32 byte segment of each chunk. Chunks whose digests match are taken
+as they are without any RS work, and the segments of the others that don't
+match are passed to the decoder as erasures, which can repair twice as many
+bad bytes as searching for the errors (see FastRSCodec.decode).
+Version 3 files hold a container (see container.py) instead of a Fernet token,
+and their digest table comes after the encoded data, so a file can be encoded
+and written a window of chunks at a time (encode_stream), and read back the
+same way (decode_stream).
+
+Journal and ranked ballot files hold a sequence of such parts (records), each
+after a length prefix with a CRC. A damaged prefix is found by its CRC and
+skipped, rather than taken for the end of the file (see record_spans).
+
+NumPy is only imported when the first codec is created, so programs that never
+touch a vote file (such as the voting terminals) start quickly. Codecs are shared
+through get_codec(), and their parity matrices (the slow part of creating a codec)
+are kept in a cache file between runs.
+"""
+
+from __future__ import annotations
+import sys
+import zlib
+import struct
+from array import array
+from functools import lru_cache
+from reedsolo import RSCodec, ReedSolomonError
+from utils import vote_path, write_atomic, isfile, stage
+
+np = None  # NumPy, imported on first use (see _import_numpy)
+
+
+# Redundancy profiles: the number of ECC symbols in each 255 byte chunk
+profiles = {
+    "none": 0,        # No error correction
+    "light": 32,      # Corrects 16 bad bytes per chunk, 223 payload bytes
+    "standard": 160,  # Corrects 80 bad bytes per chunk, 95 payload bytes (the legacy codec)
+    "paranoid": 200,  # Corrects 100 bad bytes per chunk, 55 payload bytes
+}
+default_profile = "standard"
+legacy_nsym = 160  # The number of ECC symbols in files without a header
+
+header_magic = b"VTF"
+header_version = 3
+header = struct.Struct(">3sBBB")  # Magic, version, nsym and its complement (to detect a damaged header)
+record_header = struct.Struct(">II")  # Length of each record in a journal or ranked ballot file, and a CRC32 of the length
+legacy_record_header = struct.Struct(">I")  # The length prefix of the records written before it had a CRC
+segment_size = 32  # The number of bytes covered by each digest in the digest table
+stream_window = 256  # The number of chunks encoded or decoded at once when streaming
+small_product = 1 << 20  # The largest intermediate array (in bytes) used to multiply chunks in a single step
+parallel_threshold = 256 * 1024  # Data smaller than this (in bytes) is always encoded and decoded serially
+table_cache = vote_path + "codec_tables.bin"  # The file the parity matrices are kept in between runs (None to disable)
+table_entry = struct.Struct("<HHHHH")  # The nsym, nsize, fcr, prim and generator of each parity matrix in the cache file
+
+
+def _import_numpy():
+    """Imports NumPy the first time it's needed"""
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+
+
+def _mul_nolut(x: int, y: int, prim: int) -> int:
+    """Multiplies two GF(2^8) elements without the look-up tables (used to build them)"""
+    result = 0
+    while y:
+        if y & 1:
+            result ^= x
+        y >>= 1
+        x <<= 1
+        if x & 0x100:
+            x ^= prim
+    return result
+
+
+@lru_cache(maxsize=None)
+def gf_tables(prim: int = 0x11d, generator: int = 2) -> tuple:
+    """Builds the GF(2^8) look-up tables
+    They are built once per process and shared by all the codecs
+    (and inherited by forked worker processes).
+
+    :param prim: The primitive polynomial of the field
+    :param generator: The generator of the field
+    :returns: The exponent table, the logarithm table and the full 256x256 multiplication table
+    """
+    _import_numpy()
+    gf_exp = np.zeros(510, dtype=np.uint8)
+    gf_log = np.zeros(256, dtype=np.int16)
+    x = 1
+    for i in range(255):
+        gf_exp[i] = x
+        gf_log[x] = i
+        x = _mul_nolut(x, generator, prim)
+    gf_exp[255:] = gf_exp[:255]
+
+    # gf_mul[a, b] is a * b, with the row and column for 0 left as zeros
+    gf_mul = np.zeros((256, 256), dtype=np.uint8)
+    gf_mul[1:, 1:] = gf_exp[gf_log[1:, None] + gf_log[None, 1:]]
+    return gf_exp, gf_log, gf_mul
+
+
+class FastRSCodec:
+    """A drop-in replacement for reedsolo's RSCodec with a vectorized encoder and decoder"""
+    def __init__(self, nsym: int = 10, nsize: int = 255, fcr: int = 0, prim: int = 0x11d, generator: int = 2):
+        """Initialization for the codec
+
+        :param nsym: The number of ECC symbols in each chunk
+        :param nsize: The maximum length of each chunk, including the ECC symbols (at most 255)
+        :param fcr: The first consecutive root
+        :param prim: The primitive polynomial of the field
+        :param generator: The generator of the field
+        """
+        if not 0 < nsym < nsize <= 255:
+            raise ValueError("The codec needs 0 < nsym < nsize <= 255")
+        self.nsym = nsym
+        self.nsize = nsize
+        self.fcr = fcr
+        self.prim = prim
+        self.generator = generator
+        self._reedsolo = None
+        self.gf_exp, self.gf_log, self.gf_mul = gf_tables(prim, generator)
+        # _powers[p, j] = a^((fcr + j) * (nsize - 1 - p)), the weight of byte p in syndrome j
+        degrees = np.arange(nsize - 1, -1, -1)[:, None] * (np.arange(nsym)[None, :] + fcr)
+        self._powers = self.gf_exp[degrees % 255]
+        self._parity = _cached_parity(self)
+
+    @property
+    def segments(self) -> int:
+        """The number of digests of each chunk"""
+        return -(-self.nsize // segment_size)
+
+    def digests(self, data) -> bytes:
+        """Computes the digest table of encoded data: the low 16 bits of the CRC32
+        of each segment of each chunk (an empty segment of a short last chunk gives 0)
+
+        :param data: The encoded data
+        :returns: The digest table
+        """
+        view = memoryview(bytes(data))
+        table = array("H", (zlib.crc32(view[start:min(start + segment_size, chunk + self.nsize, len(view))]) & 0xffff
+                            for chunk in range(0, len(view), self.nsize)
+                            for start in range(chunk, chunk + self.segments * segment_size, segment_size)))
+        if table.itemsize != 2:
+            raise ValueError("No 16-bit array type")
+        return table.tobytes() if sys.byteorder == "little" else _swapped(table)
+
+    def table_size(self, length: int) -> int:
+        """Works out the size of the digest table in front of encoded data
+
+        :param length: The size of the digest table and the encoded data together
+        :returns: The size of the digest table
+        """
+        per_chunk = self.nsize + 2 * self.segments
+        chunks = -(-length // per_chunk)
+        return 2 * self.segments * chunks
+
+    @property
+    def _rs(self) -> RSCodec:
+        """The reedsolo codec that corrects the chunks with errors, only created when one is found"""
+        if self._reedsolo is None:
+            self._reedsolo = RSCodec(self.nsym, self.nsize, self.fcr, self.prim, self.generator)
+        return self._reedsolo
+
+    def _parity_matrix(self) -> np.ndarray:
+        """Precomputes the ECC symbols contributed by each message byte
+        Row i holds x^(nsym + k - 1 - i) mod g(x), where k is the message length
+        of a full chunk and g(x) is the generator polynomial. Since the code is linear,
+        the ECC symbols of a chunk are the XOR of its bytes times their rows.
+
+        :returns: A k x nsym matrix
+        """
+        nsym, k = self.nsym, self.nsize - self.nsym
+        # g(x) = (x - a^fcr)(x - a^(fcr+1))...(x - a^(fcr+nsym-1)), highest degree first
+        gen = [1]
+        for i in range(nsym):
+            root = int(self.gf_exp[(i + self.fcr) % 255])
+            gen = [a ^ int(self.gf_mul[root, b]) for a, b in zip(gen + [0], [0] + gen)]
+        gen = np.array(gen[1:], dtype=np.uint8)
+
+        rows = np.zeros((k, nsym), dtype=np.uint8)
+        rem = gen.copy()  # x^nsym mod g(x)
+        for m in range(k):
+            rows[k - 1 - m] = rem
+            lead = rem[0]
+            rem = np.append(rem[1:], np.uint8(0))
+            rem ^= self.gf_mul[lead, gen]
+        return rows
+
+    def _valid_parity(self, parity: np.ndarray) -> bool:
+        """Checks a parity matrix (such as one from the cache file) by encoding a test chunk with it
+        None of the bytes of the test chunk are 0, so every row of the matrix adds to its ECC symbols,
+        and a damaged row gives an encoded chunk with errors.
+
+        :returns: Whether the encoded chunk has no errors
+        """
+        k = self.nsize - self.nsym
+        if parity.shape != (k, self.nsym) or parity.dtype != np.uint8:
+            return False
+        chunk = np.arange(1, k + 1, dtype=np.uint8)[None, :]  # k < 255, so 1 to k
+        encoded = np.concatenate([chunk, self._xor_products(chunk, parity)], axis=1)
+        return not self.syndromes(encoded).any()
+
+    def _xor_products(self, chunks: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+        """Multiplies the chunks by a matrix in GF(2^8)
+        Small inputs are done in a single step, and larger ones one column at a time
+        to keep the memory use down.
+
+        :param chunks: The matrix of chunks
+        :param matrix: A matrix with one row per byte of a chunk
+        :returns: The product, with one row per chunk
+        """
+        if chunks.size * matrix.shape[1] <= small_product:
+            return np.bitwise_xor.reduce(self.gf_mul[chunks[:, :, None], matrix], axis=1)
+        result = np.zeros((len(chunks), matrix.shape[1]), dtype=np.uint8)
+        for i in range(chunks.shape[1]):
+            result ^= self.gf_mul[chunks[:, i, None], matrix[i]]
+        return result
+
+    def encode(self, data) -> bytearray:
+        """Encodes the data by adding the ECC symbols to each chunk
+
+        :param data: The data to encode
+        :returns: The encoded data
+        """
+        if isinstance(data, str):
+            data = data.encode("latin-1")
+        k = self.nsize - self.nsym
+        if not len(data):
+            return bytearray()
+        chunks, padding = self._split(data, k)
+        count = len(chunks)
+
+        parity = self._xor_products(chunks, self._parity)
+
+        out = np.empty((count, self.nsize), dtype=np.uint8)
+        out[:, :k] = chunks
+        out[:, k:] = parity
+        if padding:
+            return bytearray(out[:-1].tobytes() + out[-1, padding:].tobytes())
+        return bytearray(out.tobytes())
+
+    @property
+    def window(self) -> int:
+        """The number of chunks encoded or decoded at once when streaming"""
+        return stream_window
+
+    def encode_stream(self, pieces):
+        """Encodes data given in pieces of any size, a window of chunks at a time
+
+        :param pieces: An iterable of the data, in pieces
+        :returns: A generator of the encoded windows
+        """
+        size = self.window * (self.nsize - self.nsym)
+        buffer = bytearray()
+        for piece in pieces:
+            buffer += piece
+            while len(buffer) >= size:
+                yield stage("rs_encode", self.encode, bytes(buffer[:size]))
+                del buffer[:size]
+        if buffer:
+            yield stage("rs_encode", self.encode, bytes(buffer))
+
+    def decode_stream(self, pieces, digests: bytes = None):
+        """Decodes data given in pieces of any size, a window of chunks at a time
+
+        :param pieces: An iterable of the encoded data, in pieces
+        :param digests: The digest table of the whole data, if any (see decode)
+        :returns: A generator of the decoded windows
+        """
+        size, table = self.window * self.nsize, self.window * 2 * self.segments
+        buffer, window = bytearray(), 0
+        part = lambda: None if digests is None else digests[window * table:(window + 1) * table]
+        for piece in pieces:
+            buffer += piece
+            while len(buffer) >= size:
+                yield bytes(stage("rs_decode", self.decode, bytes(buffer[:size]), digests=part())[0])
+                del buffer[:size]
+                window += 1
+        if buffer:
+            yield bytes(stage("rs_decode", self.decode, bytes(buffer), digests=part())[0])
+
+    def _split(self, data, size: int) -> tuple:
+        """Splits the data into a matrix of chunks
+        A shorter last chunk is padded with leading zeros, which don't change
+        its ECC symbols or its syndromes.
+
+        :param data: The data to split
+        :param size: The length of each chunk
+        :returns: The chunks and the padding of the last one
+        """
+        buf = np.frombuffer(bytes(data), dtype=np.uint8)
+        count = -(-len(buf) // size)
+        full = (count - 1) * size
+        padding = count * size - len(buf)
+        chunks = np.zeros((count, size), dtype=np.uint8)
+        chunks[:-1] = buf[:full].reshape(-1, size)
+        chunks[-1, padding:] = buf[full:]
+        return chunks, padding
+
+    def syndromes(self, chunks: np.ndarray) -> np.ndarray:
+        """Computes the syndromes of every chunk at once
+
+        :param chunks: The matrix of encoded chunks
+        :returns: A matrix with the syndromes of each chunk, all zeros for a chunk without errors
+        """
+        return self._xor_products(chunks, self._powers)
+
+    def _located(self, data, digests: bytes) -> dict:
+        """Compares the data with its digest table to find the damaged segments
+
+        :param data: The encoded data
+        :param digests: The digest table written with the data
+        :returns: The positions (inside the chunk) of the bytes of the damaged segments, by chunk
+        """
+        count = -(-len(data) // self.nsize)
+        if len(digests) != 2 * self.segments * count:
+            raise ValueError("The digest table doesn't match the data")
+        found = np.frombuffer(self.digests(data), dtype=np.uint8).reshape(count, -1, 2)
+        expected = np.frombuffer(digests, dtype=np.uint8).reshape(count, -1, 2)
+        damaged = (found != expected).any(axis=2)
+        located = {}
+        for chunk, segment in zip(*np.nonzero(damaged)):
+            size = min(self.nsize, len(data) - chunk * self.nsize)
+            start = segment * segment_size
+            located.setdefault(int(chunk), []).extend(range(start, min(start + segment_size, size)))
+        return located
+
+    def _repair(self, chunk: bytes, located: list) -> tuple:
+        """Corrects a chunk whose digests don't match
+        reedsolo's erasure decoding gets slower with each erasure, so a few damaged segments are
+        decoded as erasures, and many of them (such as a few bad bytes in every segment) are searched
+        for errors first, which only succeeds for up to nsym / 2 bad bytes. Any failed attempt
+        (including when a 16-bit digest missed some damage) falls through to the next one.
+
+        :param chunk: The chunk
+        :param located: The positions of the bytes of the damaged segments in the chunk
+        :returns: The corrected chunk with its ECC symbols and the errata positions
+        """
+        if len(located) <= self.nsym // 2:
+            attempts = ((located, True), (located, False), (None, False))
+        elif len(located) <= self.nsym:
+            attempts = ((None, False), (located, True), (located, False))
+        else:
+            attempts = ((None, False),)
+        for number, (erase_pos, only_erasures) in enumerate(attempts, 1):
+            try:
+                return self._rs.decode(chunk, erase_pos=erase_pos, only_erasures=only_erasures)[1:]
+            except ReedSolomonError:
+                if number == len(attempts):
+                    raise
+
+    def decode(self, data, nsym: int = None, erase_pos: list = None, only_erasures: bool = False,
+               digests: bytes = None) -> tuple:
+        """Decodes the data, correcting the errors in it
+        Chunks without errors (and without erasures) are returned as they are,
+        and the others are corrected with reedsolo.
+        With a digest table (see digests()), the chunks whose digests match aren't checked
+        at all, and the damaged segments of the others are corrected as erasures
+        (or searched for errors, if there are more of them than ECC symbols).
+
+        :param data: The data to decode
+        :param nsym: Not supported, kept for compatibility with RSCodec
+        :param erase_pos: The positions of the known erasures in the data
+        :param only_erasures: Whether to correct the erasures only
+        :param digests: The digest table written with the data, if any
+        :returns: The decoded data, the corrected data with its ECC symbols and the errata positions
+        """
+        if nsym not in (None, self.nsym):
+            return self._rs.decode(data, nsym, erase_pos, only_erasures)
+        if not len(data):
+            return bytearray(), bytearray(), bytearray()
+        n, k = self.nsize, self.nsize - self.nsym
+        chunks, padding = self._split(data, n)
+        count = len(chunks)
+
+        erasures = {}
+        for pos in erase_pos or ():
+            erasures.setdefault(pos // n, []).append(pos % n)
+        errata = [erasures.get(i, []) for i in range(count)]
+        located = self._located(data, digests) if digests is not None and not erase_pos else None
+        if located is None:
+            dirty = set(np.flatnonzero(self.syndromes(chunks).any(axis=1)).tolist()) | set(erasures)
+        else:
+            dirty = set(located)
+        for i in sorted(dirty):
+            start = padding if i == count - 1 else 0
+            chunk = chunks[i, start:].tobytes()
+            if located is not None:
+                corrected, errata[i] = self._repair(chunk, located[i])
+            else:
+                corrected, errata[i] = self._rs.decode(chunk, erase_pos=erasures.get(i), only_erasures=only_erasures)[1:]
+            chunks[i, start:] = np.frombuffer(bytes(corrected), dtype=np.uint8)
+
+        dec, dec_full = chunks[:, :k].tobytes(), chunks.tobytes()
+        if padding:
+            # Remove the padding of the last chunk again
+            dec = dec[:(count - 1) * k] + chunks[-1, padding:k].tobytes()
+            dec_full = dec_full[:(count - 1) * n] + chunks[-1, padding:].tobytes()
+        return bytearray(dec), bytearray(dec_full), bytearray(pos for chunk in errata for pos in chunk)
+
+    def check(self, data, nsym: int = None) -> list:
+        """Checks whether each chunk of the data is free of errors
+
+        :param data: The data to check
+        :param nsym: Not supported, kept for compatibility with RSCodec
+        :returns: A list with the result for each chunk
+        """
+        if nsym not in (None, self.nsym):
+            return self._rs.check(data, nsym)
+        if not len(data):
+            return []
+        chunks = self._split(data, self.nsize)[0]
+        return (~self.syndromes(chunks).any(axis=1)).tolist()
+
+    def damaged(self, data, digests: bytes = None) -> list:
+        """Finds the chunks with errors, from their digests (see digests()) or from their syndromes
+
+        :param data: The encoded data
+        :param digests: The digest table written with the data, if any
+        :returns: The positions of the damaged chunks
+        """
+        if digests is None:
+            return [i for i, clean in enumerate(self.check(data)) if not clean]
+        return sorted(self._located(data, digests))
+
+
+_pools = {}          # Process pools, by number of workers
+_worker_codecs = {}  # Codecs used inside a worker process, by their parameters
+_codecs = {}         # Codecs shared by get_codec(), by their parameters
+_parity_cache = None # The parity matrices from the cache file, by their codec parameters
+
+
+def _load_parity_cache() -> dict:
+    """Reads the parity matrices from the cache file, in a single read
+
+    :returns: The parity matrices, by their codec parameters
+    """
+    cache = {}
+    if not table_cache or not isfile(table_cache):
+        return cache
+    with open(table_cache, "rb") as file:
+        data = file.read()
+    offset = 0
+    while offset + table_entry.size <= len(data):
+        params = table_entry.unpack_from(data, offset)
+        offset += table_entry.size
+        size = (params[1] - params[0]) * params[0]
+        if offset + size > len(data):
+            break  # Cut short, the rest is built again
+        cache[params] = np.frombuffer(data, np.uint8, size, offset).reshape(params[1] - params[0], params[0])
+        offset += size
+    return cache
+
+
+def _cached_parity(codec: FastRSCodec) -> np.ndarray:
+    """Gets the parity matrix of a codec from the cache file, computing (and caching) it if needed
+
+    :param codec: The codec, with its parameters set
+    :returns: The parity matrix
+    """
+    global _parity_cache
+    params = (codec.nsym, codec.nsize, codec.fcr, codec.prim, codec.generator)
+    if _parity_cache is None:
+        _parity_cache = _load_parity_cache()
+    if params in _parity_cache and not codec._valid_parity(_parity_cache[params]):
+        del _parity_cache[params]  # A damaged entry would silently produce wrong ECC symbols
+    if params not in _parity_cache:
+        _parity_cache[params] = codec._parity_matrix()
+        if table_cache:
+            data = b"".join(table_entry.pack(*key) + parity.tobytes() for key, parity in _parity_cache.items())
+            try:
+                write_atomic(table_cache, data, False)
+            except OSError:
+                pass  # The cache is optional, so a read-only folder is fine
+    return _parity_cache[params]
+
+
+def _get_pool(workers: int):
+    """:returns: The process pool with the given number of workers, created on first use"""
+    if workers not in _pools:
+        from concurrent.futures import ProcessPoolExecutor
+        _pools[workers] = ProcessPoolExecutor(workers)
+    return _pools[workers]
+
+
+def _run_part(params: tuple, data: bytes, decode: bool, erase_pos: list, digests: bytes = None):
+    """Encodes or decodes a part of the data inside a worker process
+
+    :param params: The parameters of the codec
+    :param data: The part of the data, starting and ending on chunk boundaries
+    :param decode: Whether to decode the data instead of encoding it
+    :param erase_pos: The positions of the known erasures in the part
+    :param digests: The part of the digest table that covers the part of the data
+    :returns: The result of FastRSCodec.encode or FastRSCodec.decode
+    """
+    if params not in _worker_codecs:
+        _worker_codecs[params] = FastRSCodec(*params)
+    codec = _worker_codecs[params]
+    return codec.decode(data, erase_pos=erase_pos, digests=digests) if decode else codec.encode(data)
+
+
+def _swapped(table: array) -> bytes:
+    """:returns: The table as little-endian bytes, on a big-endian machine"""
+    table = array(table.typecode, table)
+    table.byteswap()
+    return table.tobytes()
+
+
+class ParallelRSCodec(FastRSCodec):
+    """A FastRSCodec that spreads large data across a pool of worker processes"""
+    def __init__(self, nsym: int = 10, nsize: int = 255, fcr: int = 0, prim: int = 0x11d, generator: int = 2,
+                 workers: int = 2, threshold: int = parallel_threshold):
+        """Initialization for the codec
+
+        :param workers: The number of worker processes
+        :param threshold: The size (in bytes) below which the data is processed serially
+        The other parameters are the same as FastRSCodec's.
+        """
+        super().__init__(nsym, nsize, fcr, prim, generator)
+        self.workers = workers
+        self.threshold = threshold
+        self._params = (nsym, nsize, fcr, prim, generator)
+
+    @property
+    def window(self) -> int:
+        """The number of chunks encoded or decoded at once when streaming, enough to use every worker"""
+        return max(stream_window, self.workers * self.threshold // self.nsize)
+
+    def _parts(self, length: int, size: int) -> list:
+        """Splits the data into one part per worker, on chunk boundaries
+
+        :param length: The length of the data
+        :param size: The length of each chunk
+        :returns: The start and end of each part
+        """
+        step = -(-length // size // self.workers) * size
+        return [(start, min(start + step, length)) for start in range(0, length, step)]
+
+    def encode(self, data) -> bytearray:
+        """Encodes the data by adding the ECC symbols to each chunk
+
+        :param data: The data to encode
+        :returns: The encoded data
+        """
+        if len(data) < self.threshold:
+            return super().encode(data)
+        if isinstance(data, str):
+            data = data.encode("latin-1")
+        data = bytes(data)
+        k = self.nsize - self.nsym
+        pool = _get_pool(self.workers)
+        futures = [pool.submit(_run_part, self._params, data[start:end], False, None)
+                   for start, end in self._parts(len(data), k)]
+
+        # The results are written straight into the output buffer
+        out = bytearray(len(data) + -(-len(data) // k) * self.nsym)
+        view, offset = memoryview(out), 0
+        for future in futures:
+            part = future.result()
+            view[offset:offset + len(part)] = part
+            offset += len(part)
+        return out
+
+    def decode(self, data, nsym: int = None, erase_pos: list = None, only_erasures: bool = False,
+               digests: bytes = None) -> tuple:
+        """Decodes the data, correcting the errors in it
+
+        :param data: The data to decode
+        :param nsym: Not supported, kept for compatibility with RSCodec
+        :param erase_pos: The positions of the known erasures in the data
+        :param only_erasures: Whether to correct the erasures only (always serial)
+        :param digests: The digest table written with the data, if any
+        :returns: The decoded data, the corrected data with its ECC symbols and the errata positions
+        """
+        if len(data) < self.threshold or only_erasures or nsym not in (None, self.nsym):
+            return super().decode(data, nsym, erase_pos, only_erasures, digests)
+        data = bytes(data)
+        pool = _get_pool(self.workers)
+        futures = []
+        table = 2 * self.segments
+        for start, end in self._parts(len(data), self.nsize):
+            part_erasures = [pos - start for pos in erase_pos or () if start <= pos < end]
+            part_digests = None if digests is None else digests[start // self.nsize * table:-(-end // self.nsize) * table]
+            futures.append(pool.submit(_run_part, self._params, data[start:end], True, part_erasures, part_digests))
+
+        dec = bytearray(len(data) - -(-len(data) // self.nsize) * self.nsym)
+        dec_full = bytearray(len(data))
+        errata = bytearray()
+        dec_view, full_view = memoryview(dec), memoryview(dec_full)
+        dec_offset = full_offset = 0
+        for future in futures:
+            part, part_full, part_errata = future.result()
+            dec_view[dec_offset:dec_offset + len(part)] = part
+            full_view[full_offset:full_offset + len(part_full)] = part_full
+            dec_offset += len(part)
+            full_offset += len(part_full)
+            errata.extend(part_errata)
+        return dec, dec_full, errata
+
+
+class NullCodec:
+    """A codec without any error correction, for the "none" profile"""
+    nsym = 0
+
+    def encode(self, data) -> bytearray:
+        """:returns: The data as it is"""
+        return bytearray(data)
+
+    def encode_stream(self, pieces):
+        """:returns: The pieces as they are"""
+        return (bytes(piece) for piece in pieces)
+
+    def decode_stream(self, pieces, digests: bytes = None):
+        """:returns: The pieces as they are"""
+        return (bytes(piece) for piece in pieces)
+
+    def digests(self, data) -> bytes:
+        """:returns: An empty digest table, since nothing could be repaired anyway"""
+        return b""
+
+    def table_size(self, length: int) -> int:
+        """:returns: The size of the (empty) digest table"""
+        return 0
+
+    def decode(self, data, nsym: int = None, erase_pos: list = None, only_erasures: bool = False,
+               digests: bytes = None) -> tuple:
+        """:returns: The data as it is, in the same form as RSCodec.decode"""
+        return bytearray(data), bytearray(data), bytearray()
+
+    def check(self, data, nsym: int = None) -> list:
+        """:returns: A single result, since there is no way to tell"""
+        return [True]
+
+    def damaged(self, data, digests: bytes = None) -> list:
+        """:returns: No damaged chunks, since there is no way to tell"""
+        return []
+
+
+def get_codec(nsym: int, workers: int = 0):
+    """Gets the codec for the given number of ECC symbols
+    Codecs are created once and shared, since they don't change after they are created.
+
+    :param nsym: The number of ECC symbols in each chunk
+    :param workers: The number of worker processes for large data (0 or 1 to stay serial)
+    :returns: The codec
+    """
+    workers = workers if workers > 1 and nsym else 0
+    if (nsym, workers) not in _codecs:
+        if not nsym:
+            _codecs[nsym, workers] = NullCodec()
+        elif workers:
+            _codecs[nsym, workers] = ParallelRSCodec(nsym, workers=workers)
+        else:
+            _codecs[nsym, workers] = FastRSCodec(nsym)
+    return _codecs[nsym, workers]
+
+
+def pack_header(nsym: int) -> bytes:
+    """Creates the header of a vote file (its digest table goes at the end of the file)
+
+    :param nsym: The number of ECC symbols the file is encoded with
+    :returns: The header
+    """
+    return header.pack(header_magic, header_version, nsym, nsym ^ 0xff)
+
+
+def unpack_header(data, length: int = None) -> tuple:
+    """Reads the header of a vote file
+    Files without a header are legacy files encoded with RSCodec(160). Version 1 files don't
+    have a digest table, version 2 files have it right after the header and version 3 files
+    at the end. Only version 3 files hold a container rather than a Fernet token.
+
+    :param data: The contents of the vote file, or at least its first header.size bytes
+    :param length: The size of the vote file (len(data) by default)
+    :returns: The version (0 for legacy files), the number of ECC symbols, and the (start, end)
+              positions of the encoded data and of the digest table (None if the file doesn't have one)
+    """
+    length = len(data) if length is None else length
+    if data[:len(header_magic)] != header_magic:
+        return 0, legacy_nsym, (0, length), None
+    magic, version, nsym, check = header.unpack_from(data)
+    if not 1 <= version <= header_version or nsym ^ check != 0xff:
+        raise ReedSolomonError("Invalid vote file header")
+    if version == 1:
+        return version, nsym, (header.size, length), None
+    size = get_codec(nsym).table_size(length - header.size)
+    if version == 2:
+        return version, nsym, (header.size + size, length), (header.size, header.size + size)
+    return version, nsym, (header.size, length - size), (length - size, length)
+
+
+def pack_record(blob: bytes) -> bytes:
+    """:returns: A record of a journal or ranked ballot file: the data after its length prefix"""
+    return record_prefix(len(blob)) + blob
+
+
+def record_prefix(length: int) -> bytes:
+    """:returns: The length prefix of a record of the given size"""
+    return record_header.pack(length, zlib.crc32(legacy_record_header.pack(length)))
+
+
+def _next_record(read, position: int, length: int) -> int:
+    """Finds the next record after a damaged length prefix: a valid prefix followed by a vote file header
+
+    :param read: Called with a position and a size, returns the bytes of the file there
+    :param position: The position of the data of the record whose prefix is damaged
+    :param length: The size of the file
+    :returns: The position of the next record's prefix (length if there is none)
+    """
+    data = read(position, length - position)
+    found = data.find(header_magic, record_header.size)
+    while found != -1:
+        size, check = record_header.unpack_from(data, found - record_header.size)
+        if check == zlib.crc32(data[found - record_header.size:found - legacy_record_header.size]):
+            return position + found - record_header.size
+        found = data.find(header_magic, found + 1)
+    return length
+
+
+def record_spans(read, length: int, offset: int = 0) -> tuple:
+    """Finds the records of a journal or ranked ballot file from their length prefixes
+    A prefix whose CRC doesn't match is damaged: its record runs up to the next valid prefix
+    (or the end of the file), so the records after it aren't lost. Only a record cut short
+    at the end of the file, or the zeros a crash can leave there, count as an incomplete end.
+    Records written before the prefixes had a CRC are read too.
+
+    :param read: Called with a position and a size, returns the bytes of the file there
+    :param length: The size of the file
+    :param offset: The position of the first record
+    :returns: The (prefix, start, end) positions of each record, and the position where
+              the complete records end (length, unless the last record was cut short)
+    """
+    spans = []
+    while length - offset >= record_header.size:
+        prefix = read(offset, record_header.size + len(header_magic))
+        size, check = record_header.unpack_from(prefix)
+        if check == zlib.crc32(prefix[:legacy_record_header.size]):
+            start = offset + record_header.size
+        elif prefix[legacy_record_header.size:][:len(header_magic)] == header_magic:
+            start = offset + legacy_record_header.size
+        else:
+            end = _next_record(read, offset + record_header.size, length)
+            if end == length and not read(offset, length - offset).strip(b"\0"):
+                break
+            spans.append((offset, offset + record_header.size, end))
+            offset = end
+            continue
+        if start + size > length:
+            break  # Cut short (or still being written)
+        spans.append((offset, start, start + size))
+        offset = start + size
+    return spans, offset
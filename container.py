@@ -0,0 +1,124 @@
+"""
+Streaming encrypted containers for the vote files
+
+A container encrypts its payload in fixed-size segments with AES-GCM (or
+ChaCha20-Poly1305). It can be written and read one segment at a time, so the
+whole ciphertext never has to be in memory, and the ciphertext is stored as raw
+bytes: Fernet's base64 made it a third larger before RS encoding.
+
+Each container has its own key, derived with HKDF from the election key and a
+random salt in the container header. The segment nonces can then simply count
+up from 0. As in the STREAM construction, the nonce of the last segment is
+marked. A container that was cut short at a segment boundary, or whose segments
+were swapped around, fails to decrypt. The header is authenticated along with
+every segment.
+"""
+
+from utils import *
+
+
+container_magic = b"VTC"
+container_version = 1
+container_header = struct.Struct(">3sBBI16s")  # Magic, version, algorithm, plaintext bytes per segment, salt
+container_segment_size = 64 * 1024  # The number of plaintext bytes in each segment (the last one may be shorter)
+tag_size = 16                       # The authentication tag added to each segment
+algorithms = {"aes-gcm": 1, "chacha20-poly1305": 2}  # The AEAD algorithms, by their ID in the header
+default_algorithm = "aes-gcm"
+
+
+class ContainerException(Exception):
+    pass
+
+
+def _segment_cipher(key: bytes, algorithm: int, salt: bytes):
+    """Creates the cipher of a container
+
+    :param key: The election key (a Fernet key, see session.derive_key)
+    :param algorithm: The ID of the AEAD algorithm
+    :param salt: The salt of the container
+    :returns: The AEAD object
+    """
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+    ciphers = {algorithms["aes-gcm"]: AESGCM, algorithms["chacha20-poly1305"]: ChaCha20Poly1305}
+    if algorithm not in ciphers:
+        raise ContainerException("Unknown container algorithm")
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=container_magic + bytes([algorithm]))
+    return ciphers[algorithm](hkdf.derive(base64.urlsafe_b64decode(key)))
+
+
+def _nonce(index: int, last: bool) -> bytes:
+    """:returns: The nonce of a segment: its position, and whether it's the last one"""
+    return index.to_bytes(11, "big") + (b"\1" if last else b"\0")
+
+
+def _encrypt(segment, cipher, nonce: bytes, header: bytes) -> bytes:
+    """Encrypts a segment (with the segment first, so the stage statistics count its size)"""
+    return cipher.encrypt(nonce, segment, header)
+
+
+def _decrypt(segment, cipher, nonce: bytes, header: bytes) -> bytes:
+    """Decrypts a segment (with the segment first, so the stage statistics count its size)"""
+    return cipher.decrypt(nonce, segment, header)
+
+
+def seal_segments(key: bytes, payload, algorithm: str = default_algorithm, size: int = container_segment_size):
+    """Encrypts a payload into a container, one segment at a time
+
+    :param key: The election key
+    :param payload: The bytes to encrypt
+    :param algorithm: The AEAD algorithm (see algorithms)
+    :param size: The number of plaintext bytes in each segment
+    :returns: A generator of the container header, then each encrypted segment
+    """
+    header = container_header.pack(container_magic, container_version, algorithms[algorithm], size, urandom(16))
+    cipher = _segment_cipher(key, algorithms[algorithm], header[-16:])
+    yield header
+    view = memoryview(payload)
+    count = max(1, -(-len(view) // size))  # An empty payload still gets a (last) segment
+    for index in range(count):
+        segment = view[index * size:(index + 1) * size]
+        yield stage("aead_encrypt", _encrypt, segment, cipher, _nonce(index, index == count - 1), header)
+
+
+def open_segments(key: bytes, pieces):
+    """Decrypts a container, one segment at a time
+
+    :param key: The election key
+    :param pieces: An iterable of the bytes of the container, in pieces of any size
+    :returns: A generator of the decrypted segments
+    """
+    from cryptography.exceptions import InvalidTag
+    buffer, header, cipher, index = bytearray(), None, None, 0
+    for piece in pieces:
+        buffer += piece
+        if header is None:
+            if len(buffer) < container_header.size:
+                continue
+            header = bytes(buffer[:container_header.size])
+            magic, version, algorithm, size, salt = container_header.unpack(header)
+            if magic != container_magic or version != container_version or not size:
+                raise ContainerException("Unknown container format")
+            cipher = _segment_cipher(key, algorithm, salt)
+            sealed = size + tag_size
+            del buffer[:container_header.size]
+        # A segment is only known not to be the last one once the next one has started
+        while len(buffer) > sealed:
+            try:
+                yield stage("aead_decrypt", _decrypt, bytes(buffer[:sealed]), cipher, _nonce(index, False), header)
+            except InvalidTag:
+                raise ContainerException(f"Segment {index} of the container can't be authenticated")
+            del buffer[:sealed]
+            index += 1
+    if header is None or len(buffer) < tag_size:
+        raise ContainerException("The container is incomplete")
+    try:
+        yield stage("aead_decrypt", _decrypt, bytes(buffer), cipher, _nonce(index, True), header)
+    except InvalidTag:
+        raise ContainerException(f"Segment {index} of the container can't be authenticated (or the container was cut short)")
+
+
+def seal(key: bytes, payload, algorithm: str = default_algorithm) -> bytes:
+    """:returns: The payload encrypted into a container, all at once (see seal_segments)"""
+    return b"".join(seal_segments(key, payload, algorithm))
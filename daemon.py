@@ -0,0 +1,185 @@
+"""
+Ballot ingest daemon
+
+A single process holds the Backend of an election and accepts ballots from
+many lightweight terminals over a Unix socket or loopback TCP. Every ballot is
+checked against the candidate list, then handed to a single writer coroutine
+which stores the ballots that arrive close together as one batch.
+Terminals get their answer once their batch is stored, and never touch the vote files.
+
+The protocol is one JSON object per line in each direction:
+    {"op": "candidates"}            -> {"ok": true, "candidates": {category: [names]}}
+    {"op": "vote", "ballot": [IDs]} -> {"ok": true} or {"ok": false, "error": message}
+"""
+
+import json
+import socket
+import asyncio
+from utils import *
+from registry import CandidateRegistry
+
+
+batch_window = 20          # The time (in milliseconds) the writer waits to fill a batch
+max_batch = 4096           # The largest number of ballots stored in one batch
+backlog = 4096             # The number of terminals that can be waiting to connect at once
+
+
+class BallotDaemon:
+    """Accepts ballots from terminals and stores them in batches"""
+    def __init__(self, backend, pin: bytes, batch_window: int = batch_window, max_batch: int = max_batch):
+        """Initialization for the daemon
+
+        :param backend: The Backend, with the candidate list of the election loaded
+        :param pin: The PIN of the election
+        :param batch_window: The time (in milliseconds) the writer waits to fill a batch
+        :param max_batch: The largest number of ballots stored in one batch
+        """
+        self.backend = backend
+        self.pin = pin
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.stored = 0
+        self._queue = None
+
+    def validate(self, ballot) -> tuple:
+        """Checks that a ballot has exactly one valid candidate for each category
+
+        :param ballot: The candidate IDs, in the order of the categories
+        :returns: The ballot as a tuple
+        """
+        ranges = self.backend.registry.ranges
+        if not isinstance(ballot, list) or len(ballot) != len(ranges):
+            raise ValueError("A ballot needs one candidate for each category")
+        for vote, ids in zip(ballot, ranges):
+            if type(vote) is not int or vote not in ids:
+                raise ValueError("Invalid candidate: " + str(vote))
+        return tuple(ballot)
+
+    async def serve(self, host: str = default_host, port: int = default_port, socket_path: str = None):
+        """Runs the daemon until it is cancelled
+
+        :param host: The address to listen on (loopback by default)
+        :param port: The TCP port to listen on
+        :param socket_path: The path of a Unix socket to listen on instead of TCP
+        """
+        self._queue = asyncio.Queue()
+        writer = asyncio.create_task(self._writer())
+        if socket_path:
+            server = await asyncio.start_unix_server(self._handle, socket_path, backlog=backlog)
+        else:
+            server = await asyncio.start_server(self._handle, host, port, backlog=backlog)
+        debug("Daemon: Listening on %s", socket_path or (host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            writer.cancel()
+            self.backend.close()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Answers the requests of one terminal"""
+        try:
+            try:
+                async for line in reader:
+                    try:
+                        response = await self._dispatch(json.loads(line))
+                    except Exception as e:
+                        response = {"ok": False, "error": str(e)}
+                    writer.write(json.dumps(response).encode() + b"\n")
+                    await writer.drain()
+            except ValueError:
+                # A line over the stream limit (64 KiB): the rest of it can't be told apart from the next request
+                writer.write(json.dumps({"ok": False, "error": "Request too long"}).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, request: dict) -> dict:
+        """Runs a request
+
+        :param request: The decoded request
+        :returns: The response
+        """
+        registry = self.backend.registry
+        if request.get("op") == "candidates":
+            return {"ok": True, "candidates": dict(zip(registry.categories, registry.names))}
+        if request.get("op") == "vote":
+            done = asyncio.get_running_loop().create_future()
+            await self._queue.put((self.validate(request.get("ballot")), done))
+            return {"ok": await done}
+        raise ValueError("Unknown request")
+
+    async def _writer(self):
+        """Stores the queued ballots, in batches, one batch at a time"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_window / 1000
+            while len(batch) < self.max_batch:
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self._queue.get_nowait())
+
+            # The Backend blocks on file I/O, so it runs in a thread while the terminals are served
+            ballots = [ballot for ballot, done in batch]
+            try:
+                stored = bool(await loop.run_in_executor(None, self.backend.store_votes_many, self.pin, ballots))
+            except Exception as e:
+                self.backend.error_handler(e)
+                stored = False
+            if stored:
+                self.stored += len(batch)
+            debug("Daemon: Batch of %d ballots stored: %s", len(batch), stored)
+            for ballot, done in batch:
+                if not done.done():
+                    done.set_result(stored)
+
+
+class RemoteBackend:
+    """The client side of the daemon, with the parts of the Backend API a voting terminal needs"""
+    def __init__(self, host: str = default_host, port: int = default_port, socket_path: str = None):
+        """Connects to the daemon and loads the candidate list
+
+        :param host: The address of the daemon
+        :param port: The TCP port of the daemon
+        :param socket_path: The path of the Unix socket of the daemon, instead of TCP
+        """
+        if socket_path:
+            self._socket = socket.socket(socket.AF_UNIX)
+            self._socket.connect(socket_path)
+        else:
+            self._socket = socket.create_connection((host, port))
+        self._file = self._socket.makefile("rwb")
+        self.candidates = self.request(op="candidates")["candidates"]
+        self.registry = CandidateRegistry(self.candidates)
+
+    def request(self, **request) -> dict:
+        """Sends a request to the daemon and waits for the response"""
+        self._file.write(json.dumps(request).encode() + b"\n")
+        self._file.flush()
+        response = json.loads(self._file.readline())
+        if not response.get("ok") and "error" in response:
+            raise ValueError(response["error"])
+        return response
+
+    def store_votes(self, pin, votes) -> bool:
+        """Sends a ballot to the daemon (the daemon holds the PIN, so pin is ignored)
+
+        :param votes: The candidate IDs from get_vote()
+        :returns: Whether the ballot was stored successfully?
+        """
+        return self.request(op="vote", ballot=list(votes))["ok"]
+
+    def close(self):
+        """Disconnects from the daemon"""
+        self._file.close()
+        self._socket.close()
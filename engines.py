@@ -0,0 +1,244 @@
+"""
+Tally engines for ranked ballots: instant-runoff, approval, Borda and plurality
+
+Ranked ballots can't be added up into counters like the votes of store_votes,
+so they are kept as they are, one integer matrix per category: a row for each
+ballot, holding the positions of the chosen candidates in the category, in
+order of preference. Shorter rankings are padded with the number of candidates
+in the category (which isn't a valid position), so a category with fewer than
+255 candidates only needs one byte per preference.
+
+Each engine counts a whole category with NumPy operations over the matrix,
+so an instant-runoff round costs a few array operations, whatever the number
+of ballots. New methods can be added to tally_engines.
+
+NumPy is only imported when ranked ballots are first stored or counted, so
+listing the tally methods (as the interactive prototype does) stays quick.
+"""
+
+from __future__ import annotations
+import struct
+from abc import ABC, abstractmethod
+
+np = None  # NumPy, imported on first use (see _import_numpy)
+
+
+ranked_magic = b"VTR"
+ranked_version = 1
+ranked_header = struct.Struct("<3sBH")  # Magic, version, number of categories
+matrix_header = struct.Struct("<IHH")   # Number of ballots, preferences per ballot, number of candidates
+
+
+class RankedException(Exception):
+    pass
+
+
+def _import_numpy():
+    """Imports NumPy the first time it's needed"""
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+
+
+def matrix_dtype(candidates: int):
+    """:returns: The smallest integer type that holds the positions of the candidates and the padding"""
+    _import_numpy()
+    return np.uint8 if candidates < 0xff else np.uint16
+
+
+def ballot_matrix(rankings: list, candidates: int) -> np.ndarray:
+    """Builds the matrix of a category
+
+    :param rankings: The ranking of each ballot, as positions of candidates in the category
+    :param candidates: The number of candidates in the category
+    :returns: The matrix, padded with the number of candidates
+    """
+    _import_numpy()
+    width = max(map(len, rankings), default=0)
+    matrix = np.full((len(rankings), width), candidates, dtype=matrix_dtype(candidates))
+    for row, ranking in enumerate(rankings):
+        matrix[row, :len(ranking)] = ranking
+    return matrix
+
+
+def join_matrices(matrices: list, candidates: int) -> np.ndarray:
+    """Stacks the matrices of a category, padding the narrower ones
+
+    :param matrices: The matrices, see ballot_matrix()
+    :param candidates: The number of candidates in the category
+    :returns: A single matrix with all the ballots
+    """
+    _import_numpy()
+    width = max((matrix.shape[1] for matrix in matrices), default=0)
+    joined = np.full((sum(map(len, matrices)), width), candidates, dtype=matrix_dtype(candidates))
+    row = 0
+    for matrix in matrices:
+        joined[row:row + len(matrix), :matrix.shape[1]] = matrix
+        row += len(matrix)
+    return joined
+
+
+def pack_ranked(matrices: list, sizes: list) -> bytes:
+    """Converts the matrices of the categories to bytes
+
+    :param matrices: The matrix of each category
+    :param sizes: The number of candidates in each category
+    :returns: The packed matrices
+    """
+    _import_numpy()
+    data = [ranked_header.pack(ranked_magic, ranked_version, len(matrices))]
+    for matrix, size in zip(matrices, sizes):
+        data.append(matrix_header.pack(matrix.shape[0], matrix.shape[1], size))
+        data.append(matrix.astype(np.dtype(matrix_dtype(size)).newbyteorder("<"), copy=False).tobytes())
+    return b"".join(data)
+
+
+def unpack_ranked(payload: bytes, sizes: list) -> list:
+    """Reads the matrices of the categories
+
+    :param payload: The packed matrices, see pack_ranked()
+    :param sizes: The number of candidates in each category, to check the matrices against
+    :returns: The matrix of each category
+    """
+    _import_numpy()
+    magic, version, count = ranked_header.unpack_from(payload)
+    if magic != ranked_magic or version != ranked_version:
+        raise RankedException("Unknown ranked ballot format")
+    if count != len(sizes):
+        raise RankedException("The ranked ballots belong to a different candidate list")
+    matrices, offset = [], ranked_header.size
+    for size in sizes:
+        rows, width, candidates = matrix_header.unpack_from(payload, offset)
+        offset += matrix_header.size
+        if candidates != size:
+            raise RankedException("The ranked ballots belong to a different candidate list")
+        dtype = np.dtype(matrix_dtype(size)).newbyteorder("<")
+        matrix = np.frombuffer(payload, dtype, rows * width, offset).reshape(rows, width)
+        offset += matrix.nbytes
+        matrices.append(matrix.astype(matrix_dtype(size)))
+    return matrices
+
+
+def ranking(names: tuple, scores) -> list:
+    """:returns: The (name, score) of each candidate, highest score first, ties in the order of the candidate file"""
+    order = sorted(range(len(names)), key=lambda i: -scores[i])
+    return [(names[i], scores[i]) for i in order]
+
+
+class TallyEngine(ABC):
+    """Counts the ranked ballots of a category"""
+    name = None
+
+    @abstractmethod
+    def tally(self, matrix: np.ndarray, names: tuple) -> dict:
+        """Counts the ballots of a category
+
+        :param matrix: The ballots of the category (see ballot_matrix)
+        :param names: The candidate names of the category
+        :returns: The result, with the method, the number of ballots and the winners (more than one if they are tied)
+        """
+
+
+class ScoringEngine(TallyEngine):
+    """Counts the ranked ballots of a category by giving each candidate a score"""
+
+    @abstractmethod
+    def scores(self, matrix: np.ndarray, candidates: int) -> np.ndarray:
+        """Works out the score of each candidate
+
+        :param matrix: The ballots of the category (see ballot_matrix)
+        :param candidates: The number of candidates in the category
+        :returns: The score of each candidate
+        """
+
+    def tally(self, matrix: np.ndarray, names: tuple) -> dict:
+        """Counts the ballots of a category
+
+        :param matrix: The ballots of the category (see ballot_matrix)
+        :param names: The candidate names of the category
+        :returns: The scores, the ranking and the winners (more than one if they are tied)
+        """
+        _import_numpy()
+        scores = self.scores(matrix, len(names)).tolist()
+        top = max(scores, default=0)
+        winners = [name for name, score in zip(names, scores) if top and score == top]
+        return {"method": self.name, "ballots": len(matrix), "scores": dict(zip(names, scores)),
+                "ranking": ranking(names, scores), "winners": winners}
+
+
+class PluralityEngine(ScoringEngine):
+    """Only the first preference of each ballot counts"""
+    name = "plurality"
+
+    def scores(self, matrix: np.ndarray, candidates: int) -> np.ndarray:
+        if not matrix.shape[1]:
+            return np.zeros(candidates, dtype=np.int64)
+        first = matrix[:, 0]
+        return np.bincount(first[first < candidates], minlength=candidates)
+
+
+class ApprovalEngine(ScoringEngine):
+    """Every candidate on a ballot gets one point, whatever its position"""
+    name = "approval"
+
+    def scores(self, matrix: np.ndarray, candidates: int) -> np.ndarray:
+        return np.bincount(matrix[matrix < candidates], minlength=candidates)
+
+
+class BordaEngine(ScoringEngine):
+    """A candidate gets one point for each candidate ranked below it: n - 1 for a first preference,
+    down to 0 for the last place. Candidates left off a ballot get nothing from it."""
+    name = "borda"
+
+    def scores(self, matrix: np.ndarray, candidates: int) -> np.ndarray:
+        points = np.broadcast_to(candidates - 1 - np.arange(matrix.shape[1]), matrix.shape)
+        ranked = matrix < candidates
+        return np.bincount(matrix[ranked], weights=points[ranked], minlength=candidates).astype(np.int64)
+
+
+class InstantRunoffEngine(TallyEngine):
+    """Each round counts the first preference of each ballot among the candidates still running.
+    A candidate with more than half of these votes wins, otherwise the last one is eliminated
+    (ties for the last place are broken by the earlier rounds, then by the order of the candidate file)."""
+    name = "irv"
+
+    def tally(self, matrix: np.ndarray, names: tuple) -> dict:
+        _import_numpy()
+        candidates = len(names)
+        running = np.ones(candidates + 1, dtype=bool)
+        running[candidates] = False  # The padding
+        rows = np.arange(len(matrix))
+        rounds, history = [], []
+        while True:
+            # The first preference of each ballot that is still running, in a few array operations
+            valid = running[matrix]
+            active = valid.any(axis=1) if matrix.shape[1] else np.zeros(len(matrix), dtype=bool)
+            choices = matrix[rows[active], valid[active].argmax(axis=1)] if active.any() else np.array([], dtype=int)
+            counts = np.bincount(choices, minlength=candidates)
+            remaining = np.flatnonzero(running[:candidates])
+            current = {names[i]: int(counts[i]) for i in remaining}
+            rounds.append({"counts": current, "exhausted": int(len(matrix) - active.sum())})
+            history.append(counts)
+
+            total = int(counts.sum())
+            top = max(current.values(), default=0)
+            lowest = min(current.values(), default=0)
+            if not total:
+                winners = []
+                break
+            if top * 2 > total or lowest == top:
+                winners = [name for name in current if current[name] == top]
+                break
+            last = [i for i in remaining if counts[i] == lowest]
+            for past in reversed(history[:-1]):
+                if len(last) == 1:
+                    break
+                fewest = min(past[i] for i in last)
+                last = [i for i in last if past[i] == fewest]
+            running[last[-1]] = False
+            rounds[-1]["eliminated"] = names[last[-1]]
+        return {"method": self.name, "ballots": len(matrix), "rounds": rounds, "winners": winners}
+
+
+tally_engines = {engine.name: engine for engine in (PluralityEngine(), InstantRunoffEngine(), ApprovalEngine(), BordaEngine())}
@@ -0,0 +1,149 @@
+"""
+Bulk import of ballots from CSV or JSONL files
+
+A file is streamed through a pipeline of generators: the rows are read one
+at a time, each one is checked against the candidate list and converted to
+candidate IDs, and the Backend stores them in batches. Only one batch is ever
+in memory, and rows that aren't valid ballots are counted and skipped.
+That includes rows with bytes that aren't valid UTF-8: the file is opened with
+errors="surrogateescape" (see open_ballots), which keeps them as surrogates.
+
+In a CSV file, the header holds the category names and each row the chosen
+candidate names. In a JSONL file, each line is an object mapping each
+category name to the chosen candidate name.
+"""
+
+import csv
+import json
+from utils import *
+
+
+import_formats = ("csv", "jsonl")
+max_rejections = 100       # The number of rejected rows whose reasons are kept for the report
+
+
+class ImportException(Exception):
+    pass
+
+
+def guess_format(filename: str) -> str:
+    """:returns: The format of the file, from its extension"""
+    extension = splitext(filename)[1].lower().lstrip(".")
+    if extension in ("json", "ndjson"):
+        return "jsonl"
+    if extension not in import_formats:
+        raise ImportException("Unknown file format: " + filename)
+    return extension
+
+
+def open_ballots(filename: str):
+    """Opens a file of ballots for read_rows()
+    A byte order mark (as written by Excel) is skipped, and bytes that aren't
+    valid UTF-8 are kept as surrogates, so only the rows holding them are rejected.
+
+    :param filename: The path of the file
+    :returns: The open (text) file
+    """
+    return open(filename, newline="", encoding="utf-8-sig", errors="surrogateescape")
+
+
+def undecodable(text) -> bool:
+    """:returns: Whether the text holds bytes that weren't valid UTF-8 (see open_ballots)"""
+    if not isinstance(text, str):
+        return False
+    try:
+        text.encode("utf-8")
+        return False
+    except UnicodeEncodeError:
+        return True
+
+
+def read_rows(file, format: str):
+    """Reads the rows of a file, one at a time
+
+    :param file: The open (text) file, see open_ballots()
+    :param format: The format of the file (see import_formats)
+    :returns: A generator of (line number, row) tuples, where a row is a dict or an exception
+    """
+    if format == "csv":
+        reader = csv.DictReader(file)
+        while True:
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as e:
+                yield reader.line_num, ValueError(str(e))
+                continue
+            if any(map(undecodable, row.values())):
+                yield reader.line_num, ValueError("The row isn't valid UTF-8")
+            else:
+                yield reader.line_num, row
+    for number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            if undecodable(line):
+                raise ValueError("The line isn't valid UTF-8")
+            row = json.loads(line)
+            if not isinstance(row, dict):
+                raise ValueError("Not a JSON object")
+            yield number, row
+        except ValueError as e:
+            yield number, e
+
+
+class BallotImporter:
+    """Converts rows to ballots, keeping track of the rejected ones"""
+    def __init__(self, registry):
+        """Initialization for the importer
+
+        :param registry: The CandidateRegistry of the election
+        """
+        self.categories = registry.categories
+        self._ids = {cat: dict(zip(registry.names[cat_id], registry.ranges[cat_id]))  # Category -> name -> candidate ID
+                     for cat_id, cat in enumerate(registry.categories)}
+        self.rows = 0
+        self.rejected = 0
+        self.rejections = []  # (line number, reason) of the first rejected rows
+
+    def reject(self, number: int, reason: str):
+        """Counts a rejected row"""
+        self.rejected += 1
+        if len(self.rejections) < max_rejections:
+            self.rejections.append((number, reason))
+        debug("Import: Row %d rejected: %s", number, reason)
+
+    def to_ballot(self, row: dict) -> tuple:
+        """Converts a row to a ballot
+
+        :param row: The category names mapped to the chosen candidate names
+        :returns: The candidate IDs, in the order of the categories
+        """
+        if row.keys() != self._ids.keys():
+            missing = [cat for cat in self.categories if cat not in row]
+            raise ValueError("Missing categories: " + str(missing) if missing else "Unknown categories")
+        ballot = []
+        for cat in self.categories:
+            if row[cat] is None:
+                raise ValueError("Missing candidate for " + cat)
+            name = row[cat].strip() if isinstance(row[cat], str) else row[cat]
+            if name not in self._ids[cat]:
+                raise ValueError("Unknown candidate for " + cat + ": " + str(row[cat]))
+            ballot.append(self._ids[cat][name])
+        return tuple(ballot)
+
+    def ballots(self, rows):
+        """Converts rows to ballots, skipping the rows that aren't valid ballots
+
+        :param rows: An iterable of (line number, row) tuples, see read_rows()
+        :returns: A generator of ballots (tuples of candidate IDs)
+        """
+        for number, row in rows:
+            self.rows += 1
+            try:
+                if isinstance(row, Exception):
+                    raise row
+                yield self.to_ballot(row)
+            except (ValueError, TypeError) as e:
+                self.reject(number, str(e))
@@ -23,9 +23,10 @@ class Interface:
         if input("Do you want to register new candidates (Y for yes, otherwise no): ").lower() == "y":
             candidates = self.backend.register(input("Enter the filename: "),
                 input("Enter the PIN to be used (Warning: You can't access your vote data without the pin): ").encode(),
-                self.register())
+                self.register(), self.get_profile())
         else:
             candidates = self.backend.read_candidates(input("Enter the filename: "))
+        self.method = self.get_method()
         print()
     
     def error_handler(self, exception):
@@ -48,6 +49,7 @@ class Interface:
         while True:
             pin = input("\nEnter the PIN: ").encode()
             if self.backend.verify_pin(pin):
+                self.backend.open_session(pin)
                 return pin
             print("Invalid PIN.\n")
     
@@ -57,12 +59,18 @@ class Interface:
         """
         pin = self.get_pin()
 
-        # Get 10 votes and store them all in a file
-        for vote in [self.get_vote() for i in range(5)]:
-            self.backend.store_votes(pin, vote)
-        
+        # Get 5 votes and store them all in a file
+        if self.method == "plurality":
+            self.backend.store_votes_many(pin, (self.get_vote() for i in range(5)))
+        else:
+            self.backend.store_ranked(pin, (self.get_vote(ranked=True) for i in range(5)))
+
         # Display the results
-        self.display_votes()
+        if self.method == "plurality":
+            self.display_votes()
+        else:
+            self.display_tally(self.method)
+        self.backend.logout()
 
     def register(self):
         """The register window that allows the user to create an event.
@@ -90,60 +98,132 @@ class Interface:
         debug(candidates)
         return candidates
     
-    def get_vote(self):
+    def get_profile(self) -> str:
+        """Asks for the redundancy profile of the vote files.
+        More redundancy can repair more damage, but makes the files larger.
+
+        :returns: The name of the profile
+        """
+        while True:
+            profile = input(f"Enter the redundancy profile ({'/'.join(profiles)}, default {default_profile}): ")
+            if not profile:
+                return default_profile
+            if profile in profiles:
+                return profile
+            print("Invalid profile")
+
+    def get_method(self) -> str:
+        """Asks for the tally method. Anything other than plurality
+        uses ranked ballots (see engines.py)
+
+        :returns: The name of the method
+        """
+        from engines import tally_engines
+        while True:
+            method = input(f"Enter the tally method ({'/'.join(tally_engines)}, default plurality): ")
+            if not method:
+                return "plurality"
+            if method in tally_engines:
+                return method
+            print("Invalid method")
+
+    def get_vote(self, ranked: bool = False):
         """Gets the vote of a person from each category.
-        It returns a dict with the first element being
-        the token and the rest being hashes of the candidate details
-        to whom the vote was casted
+        It returns a tuple with the ID of the candidate
+        to whom the vote was casted in each category.
+        With ranked ballots, there is a tuple of candidate IDs
+        in order of preference for each category instead.
 
-        :returns: The votes as a dictionary
+        :param ranked: Whether to ask for a ranking instead of a single choice
+        :returns: The votes as a tuple of candidate IDs (or of tuples of them)
         """
         print("\n_____________________________________________")
+        registry = self.backend.registry
         votes = []
-        for cat in self.backend.candidates:
-            if cat == pin_key:
-                continue
-            names = self.backend.candidates[cat]
+        for cat_id, cat in enumerate(registry.categories):
+            names = registry.names[cat_id]
             l = len(names)
             print(f"Candidates for {cat}:")
             print("\n".join([f"{i+1}. {names[i]}" for i in range(l)]))
             while True:
                 try:
-                    option = int(input(f"Please choose an option from 1 to {l}: ")) - 1
-                    assert 0 <= option < l
-                except Exception as e:
+                    if ranked:
+                        options = [int(option) - 1 for option in input(
+                            "Please enter the options in order of preference, separated by spaces (e.g. 2 1 3): ").split()]
+                        assert all(0 <= option < l for option in options) and len(set(options)) == len(options)
+                    else:
+                        option = int(input(f"Please choose an option from 1 to {l}: ")) - 1
+                        assert 0 <= option < l
+                except Exception:
                     print("Invalid input")
                     continue
                 break
-            votes.append(get_hash(cat, names[option]))
+            if ranked:
+                votes.append(tuple(registry.candidate_id(cat_id, option) for option in options))
+            else:
+                votes.append(registry.candidate_id(cat_id, option))
             print()
         print("_____________________________________________")
 
-        return votes
+        return tuple(votes)
     
     def display_votes(self):
         """Displays the vote results and the winners"""
-        votes = self.backend.read_votes(self.get_pin())
-        candidates = self.backend.candidates
-        winners = {}
+        boards = self.backend.leaderboards(self.get_pin())
+        print("\n_____________________________________________")
+        for board in boards:
+            for name, votes in zip(board.names, board.counts):
+                print(f"Cat: {board.category}, Name: {name}, Votes:", votes)
+
+        print("\nWinners for each of the categories:")
+        for board in boards:
+            winners = board.winners()
+            if winners:
+                print(f"{board.category}: {' and '.join(winners)} ({board.top(1)[0][1]} votes)")
+        print("_____________________________________________")
+
+    def display_tally(self, method: str):
+        """Displays the result of a tally of the ranked ballots, with the winners
+
+        :param method: The tally method (see engines.tally_engines)
+        """
+        results = self.backend.tally(self.get_pin(), method)
         print("\n_____________________________________________")
-        for cat in candidates:
-            if cat == pin_key:
-                continue
-            for name in candidates[cat]:
-                index = get_hash(cat, name)
-                if index in votes:
-                    if cat not in winners:
-                        winners[cat] = (name, votes[index])
-                    elif votes[index] == winners[cat][1]:
-                        winners[cat] = ("{} and {}".format(winners[cat][0], name), votes[index])
-                    elif votes[index] > winners[cat][1]:
-                        winners[cat] = (name, votes[index])
-                    print(f"Cat: {cat}, Name: {name}, Votes:", votes[index])
-                else:
-                    print(f"Cat: {cat}, Name: {name}, Votes: 0")
+        for cat, result in zip(self.backend.registry.categories, results):
+            print(f"Cat: {cat}, Method: {method}, Ballots: {result['ballots']}")
+            for number, runoff in enumerate(result.get("rounds", ()), 1):
+                counts = ", ".join(f"{name}: {votes}" for name, votes in runoff["counts"].items())
+                print(f"Round {number}: {counts}" + (f" ({runoff['eliminated']} eliminated)" if "eliminated" in runoff else ""))
+            for name, score in result.get("ranking", ()):
+                print(f"Name: {name}, Score: {score}")
 
         print("\nWinners for each of the categories:")
-        for cat in winners:
-            print(f"{cat}: {winners[cat][0]} ({winners[cat][1]} votes)")
+        for cat, result in zip(self.backend.registry.categories, results):
+            if result["winners"]:
+                print(f"{cat}: {' and '.join(result['winners'])}")
         print("_____________________________________________")
+
+
+class RemoteInterface(Interface):
+    """
+    A thin voting terminal that sends the ballots to the ballot daemon (see daemon.py)
+    instead of storing them itself
+    """
+    def __init__(self, *args, **kwargs):
+        """Connects to the daemon. The arguments are passed on to RemoteBackend"""
+        from daemon import RemoteBackend  # Imported here, since only the terminals need it
+        self.backend = RemoteBackend(*args, **kwargs)
+        debug("Connected to the daemon")
+        print("Voting system - Terminal")
+        print("Designed by Pratyush")
+        print("____________________________")
+        print("(Type QUIT to close the terminal)\n")
+
+    def main(self):
+        """Takes votes until QUIT is entered"""
+        while input("Press Enter to vote: ") != "QUIT":
+            if self.backend.store_votes(None, self.get_vote()):
+                print("Your vote has been stored.\n")
+            else:
+                print("Your vote could not be stored. Please tell the staff.\n")
+        self.backend.close()
@@ -0,0 +1,129 @@
+"""
+Per-category leaderboards, kept up to date as ballots are stored
+
+The candidates of a category are kept sorted by their number of votes, with
+the candidates that have the same number of votes next to each other (a group).
+Since votes are only ever added, storing a ballot moves a candidate up past
+whole groups at once, without sorting the category again, and the winners
+are always the first group.
+"""
+
+
+class Leaderboard:
+    """The ranking of the candidates of one category"""
+    __slots__ = ("category", "names", "counts", "_order", "_position", "_head")
+
+    def __init__(self, category: str, names: tuple, counts: list):
+        """Builds the leaderboard from the current counts
+
+        :param category: The category name
+        :param names: The candidate names, in the order of the candidate file
+        :param counts: The number of votes of each candidate, in the same order
+        """
+        self.category = category
+        self.names = names
+        self.counts = list(counts)
+        self._order = sorted(range(len(names)), key=lambda i: (-self.counts[i], i))  # Position -> candidate
+        self._position = [0] * len(names)                                          # Candidate -> position
+        self._head = {}  # Number of votes -> position of the first candidate of its group
+        for position, candidate in enumerate(self._order):
+            self._position[candidate] = position
+            self._head.setdefault(self.counts[candidate], position)
+
+    def __len__(self) -> int:
+        """:returns: The number of candidates"""
+        return len(self.names)
+
+    def _swap(self, a: int, b: int):
+        """Swaps the candidates at two positions"""
+        order = self._order
+        order[a], order[b] = order[b], order[a]
+        self._position[order[a]], self._position[order[b]] = a, b
+
+    def add(self, candidate: int, votes: int = 1):
+        """Adds votes to a candidate, moving it up the ranking
+
+        :param candidate: The position of the candidate in its category
+        :param votes: The number of votes to add
+        """
+        if votes <= 0:
+            return
+        count, counts, order = self.counts[candidate], self.counts, self._order
+        target = counts[candidate] = count + votes
+
+        # Leave the old group, by moving to its front
+        position = self._head[count]
+        self._swap(self._position[candidate], position)
+        if position + 1 < len(order) and counts[order[position + 1]] == count:
+            self._head[count] = position + 1
+        else:
+            del self._head[count]
+
+        # Move past every group with fewer votes than the new count
+        while position:
+            above = counts[order[position - 1]]
+            if above > target:
+                break
+            if above == target:
+                return  # Joins the group right above, at its end
+            head = self._head[above]
+            self._swap(position, head)
+            self._head[above] = head + 1
+            position = head
+        self._head[target] = position
+
+    def _group(self, position: int) -> list:
+        """:returns: The candidates of the group starting at the position, in the order of the candidate file"""
+        order = self._order
+        count = self.counts[order[position]]
+        end = position + 1
+        while end < len(order) and self.counts[order[end]] == count:
+            end += 1
+        return sorted(order[position:end])
+
+    def ranking(self) -> list:
+        """Gets the full ranking, with tied candidates in the order of the candidate file
+
+        :returns: A list of (name, votes) tuples, most votes first
+        """
+        return self.top(len(self.names))
+
+    def top(self, k: int) -> list:
+        """Gets the first k candidates of the ranking
+
+        :param k: The number of candidates
+        :returns: A list of (name, votes) tuples, most votes first
+        """
+        result = []
+        while len(result) < min(k, len(self.names)):
+            group = self._group(len(result))
+            result.extend((self.names[i], self.counts[i]) for i in group)
+        return result[:k]
+
+    def winners(self) -> list:
+        """Gets the winners (more than one if they are tied)
+
+        :returns: The names of the winners, or an empty list if nobody has any votes
+        """
+        if not self.names or not self.counts[self._order[0]]:
+            return []
+        return [self.names[i] for i in self._group(0)]
+
+    def margin(self) -> int:
+        """:returns: The number of votes between the first and the second candidate (0 if they are tied)"""
+        if not self.names:
+            return 0
+        first = self.counts[self._order[0]]
+        return first - self.counts[self._order[1]] if len(self.names) > 1 else first
+
+    def ties(self) -> list:
+        """Gets every group of candidates with the same number of votes (apart from those with no votes)
+
+        :returns: A list of lists of names, most votes first
+        """
+        ties = []
+        for count, position in sorted(self._head.items(), reverse=True):
+            group = self._group(position)
+            if count and len(group) > 1:
+                ties.append([self.names[i] for i in group])
+        return ties
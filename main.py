@@ -4,15 +4,152 @@ Prototype (Modular)
 
 Note:
 1. This program requires the following third-party packages:
-    cryptopgraphy (for Fernet encryption)
+    cryptopgraphy (for AES-GCM and Fernet encryption)
     reedsolo (for error correction, to prevent data corruption)
+    numpy (for the fast Reed-Solomon codec)
 2. The program asks for 5 votes only, for debugging purposes
 """
 
+import argparse
+import utils
 from interface import *
 from backend import *
 
 
+def print_stage_report():
+    """Prints the statistics of each stage (see utils.stage)"""
+    print(f"\n{'Stage':<16}{'calls':>8}{'total ms':>12}{'mean ms':>10}{'bytes in':>14}{'bytes out':>14}")
+    for name, stats in sorted(stage_report().items()):
+        print(f"{name:<16}{stats['calls']:>8}{stats['seconds'] * 1000:>12.2f}{stats['mean_ms']:>10.3f}"
+              f"{stats['bytes_in']:>14}{stats['bytes_out']:>14}")
+
+
+def serve(args):
+    """Runs the ballot daemon for an election"""
+    import asyncio
+    from daemon import BallotDaemon
+    backend = Backend(lambda e: print("[ERROR]", e), durability="every-ballot")
+    if not backend.read_candidates(args.election):
+        print("Candidate list not found.")
+        return
+    pin = input("Enter the PIN: ").encode()
+    if not backend.open_session(pin):
+        print("Invalid PIN.")
+        return
+    print("Serving ballots for", args.election)
+    try:
+        asyncio.run(BallotDaemon(backend, pin).serve(args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
+
+
+def results(args):
+    """Runs the HTTP results service for an election"""
+    from results import ResultsService
+    backend = Backend(lambda e: print("[ERROR]", e))
+    if not backend.read_candidates(args.election):
+        print("Candidate list not found.")
+        return
+    pin = input("Enter the PIN: ").encode()
+    if not backend.open_session(pin):
+        print("Invalid PIN.")
+        return
+    print(f"Serving the results of {args.election} on http://{args.host}:{args.port}/results")
+    try:
+        ResultsService(backend, pin).serve(args.host, args.port)
+    except KeyboardInterrupt:
+        pass
+
+
+def import_ballots(args):
+    """Imports ballots from a CSV or JSONL file"""
+    backend = Backend(lambda e: print("[ERROR]", e))
+    if not backend.read_candidates(args.election):
+        print("Candidate list not found.")
+        return
+    pin = input("Enter the PIN: ").encode()
+    if not backend.open_session(pin):
+        print("Invalid PIN.")
+        return
+    report = backend.import_ballots(pin, args.file, args.format, args.batch_size)
+    stored = backend.logout()
+    if not report or not stored:
+        print("The import failed.")
+        return
+    if report["error"]:
+        print(f"The import stopped early: {report['error']}. The ballots stored before that are kept.")
+    print(f"{report['rows']} rows read, {report['stored']} ballots stored, {report['rejected']} rows rejected")
+    print(f"{report['seconds']:.2f} seconds ({report['rows_per_second']:.0f} rows/sec)")
+    for number, reason in report["rejections"]:
+        print(f"Line {number}: {reason}")
+    if report["rejected"] > len(report["rejections"]):
+        print(f"... and {report['rejected'] - len(report['rejections'])} more")
+
+
+def scrub(args):
+    """Checks the vote and candidate files, once or every interval"""
+    from time import sleep
+    from scrubber import Scrubber, summarize_reports
+    scrubber = Scrubber(lambda e: print("[ERROR]", e), args.rate * 1024 * 1024 if args.rate else None,
+                        args.workers, not args.check_only)
+    try:
+        while True:
+            reports = scrubber.scrub()
+            for report in reports:
+                if report["status"] != "clean":
+                    print(f"{report['status']:<12}{report['file']} ({report['damaged_chunks']} damaged chunks)")
+            summary = ", ".join(f"{count} {status}" for status, count in summarize_reports(reports).items())
+            print(len(reports), "files checked" + (": " + summary if summary else ""))
+            if not args.interval:
+                return
+            sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+
 if __name__ == "__main__":
-    ui = Interface()
-    ui.main()
+    parser = argparse.ArgumentParser(description="Voting system. Without a command, runs the interactive prototype.")
+    parser.add_argument("--debug", action="store_true", help="print debug messages")
+    parser.add_argument("--stats", action="store_true", help="print the time taken and bytes handled by each stage on exit")
+    commands = parser.add_subparsers(dest="command")
+    serve_parser = commands.add_parser("serve", help="run the ballot daemon for an election")
+    serve_parser.add_argument("election", help="the filename of the candidate list")
+    terminal_parser = commands.add_parser("terminal", help="run a voting terminal connected to the daemon")
+    for command in (serve_parser, terminal_parser):
+        command.add_argument("--host", default=default_host)
+        command.add_argument("--port", type=int, default=default_port)
+        command.add_argument("--socket", help="use this Unix socket instead of TCP")
+    results_parser = commands.add_parser("results", help="serve the results of an election over HTTP")
+    results_parser.add_argument("election", help="the filename of the candidate list")
+    results_parser.add_argument("--host", default=default_host)
+    results_parser.add_argument("--port", type=int, default=default_results_port)
+    import_parser = commands.add_parser("import", help="import ballots from a CSV or JSONL file")
+    import_parser.add_argument("election", help="the filename of the candidate list")
+    import_parser.add_argument("file", help="the CSV or JSONL file with the ballots")
+    import_parser.add_argument("--format", choices=import_formats, help="the format of the file (guessed from the extension by default)")
+    import_parser.add_argument("--batch-size", type=int, default=10000, help="the number of ballots stored at once")
+    scrub_parser = commands.add_parser("scrub", help="check the vote and candidate files, repairing the vote files")
+    scrub_parser.add_argument("--rate", type=float, default=8, help="the megabytes read per second (0 for no limit)")
+    scrub_parser.add_argument("--workers", type=int, default=os.cpu_count(), help="the number of worker processes")
+    scrub_parser.add_argument("--check-only", action="store_true", help="only report the damaged files")
+    scrub_parser.add_argument("--interval", type=float, help="check the files again every this many seconds")
+    args = parser.parse_args()
+    utils.is_debug = utils.is_debug or args.debug
+    instrument(args.stats)
+
+    if args.command == "serve":
+        serve(args)
+    elif args.command == "import":
+        import_ballots(args)
+    elif args.command == "scrub":
+        scrub(args)
+    elif args.command == "results":
+        results(args)
+    elif args.command == "terminal":
+        RemoteInterface(args.host, args.port, args.socket).main()
+    else:
+        ui = Interface()
+        ui.main()
+
+    if args.stats:
+        print_stage_report()
@@ -0,0 +1,121 @@
+"""
+Keeps many elections open at once
+
+Each election gets its own Backend, so its candidate registry, its session
+and the vote data it keeps in memory are ready whenever it's used again.
+The least recently used elections are closed (writing their pending votes
+first) when the data kept in memory goes over a budget.
+"""
+
+from collections import OrderedDict
+from utils import *
+from backend import Backend
+
+
+default_memory_budget = 64 * 1024 * 1024  # The memory (in bytes) the open elections may use together
+
+
+class ElectionManager:
+    """An LRU cache of open elections, each with its own Backend"""
+    def __init__(self, error_handler, memory_budget: int = default_memory_budget, **options):
+        """Initialization for the manager
+
+        :param error_handler: The error handler passed to every Backend
+        :param memory_budget: The memory (in bytes) the open elections may use together (see Backend.memory_usage)
+        :param options: The other arguments of Backend (journal, flush_every, durability, ...)
+        """
+        self.error_handler = error_handler
+        self.memory_budget = memory_budget
+        self.options = options
+        self._elections = OrderedDict()  # Filename -> Backend, least recently used first
+
+    def __len__(self) -> int:
+        """:returns: The number of open elections"""
+        return len(self._elections)
+
+    def __contains__(self, filename: str) -> bool:
+        """:returns: Whether the election is open"""
+        return filename in self._elections
+
+    def __getitem__(self, filename: str) -> Backend:
+        """Gets the Backend of an election, opening it if needed
+
+        :param filename: The filename of the candidate list
+        :returns: The Backend of the election
+        """
+        backend = self.get(filename)
+        if backend is None:
+            raise KeyError(filename)
+        return backend
+
+    def get(self, filename: str) -> Backend:
+        """Gets the Backend of an election, opening it if needed.
+        Its candidate list is already loaded, so it can be used right away
+        (for example, manager.get("sports").store_votes(pin, votes)).
+
+        :param filename: The filename of the candidate list
+        :returns: The Backend of the election, or None if the candidate list can't be read
+        """
+        backend = self._elections.get(filename)
+        if backend is not None:
+            self._elections.move_to_end(filename)
+        else:
+            backend = Backend(self.error_handler, **self.options)
+            if not backend.read_candidates(filename):
+                return None
+            debug("Manager: Opened %s", filename)
+            self._elections[filename] = backend
+        self.evict()
+        return backend
+
+    def memory_usage(self) -> int:
+        """:returns: The estimated memory (in bytes) used by the open elections"""
+        return sum(backend.memory_usage() for backend in self._elections.values())
+
+    def evict(self) -> int:
+        """Closes the least recently used elections until the open ones fit in the memory budget.
+        The most recently used election is always kept open.
+
+        :returns: The number of elections closed
+        """
+        closed = 0
+        usage = self.memory_usage()
+        for filename in list(self._elections)[:-1]:
+            if usage <= self.memory_budget:
+                break
+            size = self._elections[filename].memory_usage()
+            if self.close(filename):
+                usage -= size
+                closed += 1
+        return closed
+
+    def close(self, filename: str) -> bool:
+        """Closes an election, writing its pending votes first.
+        If they can't be written, the election stays open so they aren't lost.
+
+        :param filename: The filename of the candidate list
+        :returns: Whether the election was closed?
+        """
+        backend = self._elections.get(filename)
+        if backend is None:
+            return True
+        if not backend.logout():
+            self.error_handler(IOError("The pending votes of " + filename + " could not be written"))
+            return False
+        del self._elections[filename]
+        debug("Manager: Closed %s", filename)
+        return True
+
+    def flush(self) -> bool:
+        """Writes the pending votes of every open election
+
+        :returns: Whether all the votes were stored successfully?
+        """
+        return all([backend.flush() for backend in self._elections.values()])
+
+    def close_all(self) -> bool:
+        """Closes every election. Call it before the program exits.
+
+        :returns: Whether all the pending votes were stored successfully?
+        """
+        return all([self.close(filename) for filename in list(self._elections)])
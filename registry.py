@@ -0,0 +1,82 @@
+"""
+The candidate registry, built once when a candidate list is loaded
+
+Every candidate gets an integer ID (its position in the candidate file),
+so ballots can be tuples of small integers instead of lists of hashes,
+and nothing has to be hashed again while voting or counting.
+The PIN hash (or verifier) and the other election settings are kept apart from the categories.
+"""
+
+from sys import intern
+from types import MappingProxyType
+from utils import *
+
+
+class CandidateRegistry:
+    """An immutable index of the categories and candidates of an election"""
+    __slots__ = ("categories", "names", "ranges", "digests", "ids", "category_ids", "pin_hash", "profile", "salt", "verifier")
+
+    def __init__(self, candidates: dict):
+        """Builds the registry from a candidate dict (as stored in the candidate file)
+
+        :param candidates: The candidate dict
+        """
+        categories, names, ranges, digests = [], [], [], []
+        for cat in candidates:
+            if cat in reserved_keys:
+                continue
+            start = len(digests)
+            categories.append(intern(cat))
+            names.append(tuple(intern(name) for name in candidates[cat]))
+            digests.extend(get_hash(cat, name) for name in candidates[cat])
+            ranges.append(range(start, len(digests)))
+        setattr_ = super().__setattr__
+        setattr_("categories", tuple(categories))  # Category ID -> category name
+        setattr_("names", tuple(names))            # Category ID -> candidate names
+        setattr_("ranges", tuple(ranges))          # Category ID -> candidate IDs
+        setattr_("digests", tuple(digests))        # Candidate ID -> hash
+        setattr_("ids", MappingProxyType({digest: i for i, digest in enumerate(digests)}))  # Hash -> candidate ID
+        setattr_("category_ids", tuple(cat_id for cat_id, ids in enumerate(ranges) for i in ids))  # Candidate ID -> category ID
+        setattr_("pin_hash", candidates.get(pin_key))
+        setattr_("profile", candidates.get(profile_key))
+        setattr_("salt", candidates.get(salt_key))
+        setattr_("verifier", candidates.get(verifier_key))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("The candidate registry can't be changed")
+
+    def __len__(self) -> int:
+        """:returns: The number of candidates"""
+        return len(self.digests)
+
+    def candidate_id(self, cat_id: int, option: int) -> int:
+        """Gets the ID of a candidate from its position in its category
+
+        :param cat_id: The category ID
+        :param option: The position of the candidate in the category
+        :returns: The candidate ID
+        """
+        return self.ranges[cat_id][option]
+
+    def name(self, candidate_id: int) -> tuple:
+        """Gets the category and name of a candidate
+
+        :param candidate_id: The candidate ID
+        :returns: The category name and the candidate name
+        """
+        if not 0 <= candidate_id < len(self.digests):
+            raise IndexError("Unknown candidate ID")
+        cat_id = self.category_ids[candidate_id]
+        return self.categories[cat_id], self.names[cat_id][candidate_id - self.ranges[cat_id].start]
+
+    def to_id(self, vote) -> int:
+        """Converts a vote to a candidate ID
+
+        :param vote: A candidate ID, or the hash of a candidate (see utils.get_hash)
+        :returns: The candidate ID
+        """
+        if type(vote) is int:
+            if not 0 <= vote < len(self.digests):
+                raise IndexError("Unknown candidate ID")
+            return vote
+        return self.ids[vote]
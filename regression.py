@@ -0,0 +1,252 @@
+"""
+Regression checks for the Reed-Solomon codecs and the vote file formats
+
+The vectorized codecs must produce exactly the same bytes as reedsolo's RSCodec,
+and the Backend must still read the vote files written by every earlier version:
+legacy files without a header (RSCodec(160) over a Fernet token of pickled data),
+version 1 files (a header), version 2 files (a digest table after the header)
+and the current version 3 files (a container, with the digest table at the end).
+The earlier formats are written here the same way the earlier code wrote them.
+The PIN checks of new and earlier elections are checked as well.
+Everything runs in a temporary directory, so existing elections aren't touched.
+
+Usage:
+    python regression.py [--seed 0] [--workers 2]
+
+Exits with status 1 if a check fails.
+"""
+
+import sys
+import random
+import argparse
+import tempfile
+from reedsolo import RSCodec
+from utils import *
+from backend import *
+
+
+check_pin = b"1234"
+check_candidates = {"President": ["Alice", "Bob", "Carol"], "Treasurer": ["Dave", "Erin"]}
+
+
+def damage(data: bytes, nsize: int, errors: int, rng, every: int = 1) -> bytes:
+    """Flips bytes at random positions in the chunks of encoded data
+
+    :param data: The encoded data
+    :param nsize: The length of each chunk
+    :param errors: The number of bytes flipped in each damaged chunk
+    :param rng: The random generator
+    :param every: Damages one chunk out of this many (reedsolo takes a while to correct each one)
+    :returns: The damaged data
+    """
+    damaged = bytearray(data)
+    for chunk in range(0, len(damaged), nsize * every):
+        size = min(nsize, len(damaged) - chunk)
+        for pos in rng.sample(range(size), min(errors, size)):
+            damaged[chunk + pos] ^= rng.randrange(1, 256)
+    return bytes(damaged)
+
+
+def erase_segments(data: bytes, nsize: int, nsym: int, rng) -> bytes:
+    """Overwrites whole digest segments in each chunk, more bytes than an error search could correct
+
+    :param data: The encoded data
+    :param nsize: The length of each chunk
+    :param nsym: The number of ECC symbols in each chunk
+    :param rng: The random generator
+    :returns: The damaged data
+    """
+    damaged = bytearray(data)
+    count = max(1, nsym // segment_size)
+    for chunk in range(0, len(damaged), nsize):
+        size = min(nsize, len(damaged) - chunk)
+        for segment in rng.sample(range(-(-size // segment_size)), min(count, -(-size // segment_size))):
+            start = chunk + segment * segment_size
+            for pos in range(start, min(start + segment_size, chunk + size)):
+                damaged[pos] ^= 0xff
+    return bytes(damaged)
+
+
+def check_profile(profile: str, nsym: int, rng, workers: int) -> list:
+    """Compares FastRSCodec and ParallelRSCodec with reedsolo's RSCodec for a profile
+
+    :param profile: The name of the profile
+    :param nsym: The number of ECC symbols of the profile
+    :param rng: The random generator
+    :param workers: The number of worker processes of the parallel codec
+    :returns: The failed checks
+    """
+    failures = []
+    fast, reference = FastRSCodec(nsym), RSCodec(nsym)
+    k = fast.nsize - nsym
+    for size in (1, k - 1, k, k + 1, 3 * k + 17):
+        data = rng.randbytes(size)
+        encoded = bytes(fast.encode(data))
+        name = f"{profile}, {size} bytes"
+        if encoded != bytes(reference.encode(data)):
+            failures.append(f"{name}: encoding differs from reedsolo")
+            continue
+        errors = damage(encoded, fast.nsize, nsym // 2, rng)
+        decoded = fast.decode(errors)
+        if bytes(decoded[0]) != data or bytes(decoded[1]) != bytes(reference.decode(errors)[1]):
+            failures.append(f"{name}: decoding differs from reedsolo")
+        digests = fast.digests(encoded)
+        for kind, damaged in (("errors", errors), ("erasures", erase_segments(encoded, fast.nsize, nsym, rng))):
+            if bytes(fast.decode(damaged, digests=digests)[0]) != data:
+                failures.append(f"{name}: decoding {kind} with the digest table failed")
+
+    parallel = ParallelRSCodec(nsym, workers=workers)
+    data = rng.randbytes(parallel_threshold + 3 * k + 17)  # Large enough to be split across the workers
+    encoded = bytes(fast.encode(data))
+    if bytes(parallel.encode(data)) != encoded:
+        failures.append(f"{profile}: parallel encoding differs")
+    errors = damage(encoded, fast.nsize, nsym // 2, rng, every=64)
+    if bytes(parallel.decode(errors)[1]) != encoded:
+        failures.append(f"{profile}: parallel decoding differs")
+    if bytes(parallel.decode(errors, digests=fast.digests(encoded))[0]) != data:
+        failures.append(f"{profile}: parallel decoding with the digest table failed")
+    return failures
+
+
+def check_codecs(rng, workers: int) -> list:
+    """Checks the codec of each profile (see check_profile)
+
+    :param rng: The random generator
+    :param workers: The number of worker processes of the parallel codec
+    :returns: The failed checks
+    """
+    failures = []
+    for profile, nsym in profiles.items():
+        if not nsym:
+            continue
+        try:
+            failures += check_profile(profile, nsym, rng, workers)
+        except Exception as e:
+            failures.append(f"{profile}: {e!r}")
+    return failures
+
+
+def open_election(name: str) -> tuple:
+    """Reads the candidate list of an election
+
+    :param name: The file name of the election
+    :returns: A Backend with the candidate list read, and the list its errors are added to
+    """
+    errors = []
+    backend = Backend(errors.append)
+    backend.read_candidates(name)
+    return backend, errors
+
+
+def write_vote_file(name: str, version: int) -> dict:
+    """Writes an election the way the version that introduced a vote file format did,
+    with a vote for every candidate
+
+    :param name: The file name of the election
+    :param version: The header version (0 for legacy files)
+    :returns: The vote data written
+    """
+    from cryptography.fernet import Fernet
+    candidates = {cat: tuple(names) for cat, names in check_candidates.items()}
+    candidates[pin_key] = get_pin_hash(check_pin)
+    if version:
+        # Elections without a header predate the redundancy profiles and the salts
+        candidates[profile_key] = default_profile
+        candidates[salt_key] = urandom(salt_size)
+    with open(path(True, name), "wb") as file:
+        pickle.dump(candidates, file)
+    backend = open_election(name)[0]
+    votes = {digest: i + 1 for i, digest in enumerate(backend.registry.digests)}
+    if version == 0:
+        # RSCodec(160) over a Fernet token of the pickled data, with the unsalted key
+        token = Fernet(get_key(get_pin_hash(check_pin), check_pin)).encrypt(pickle.dumps(votes))
+        data = bytes(RSCodec(legacy_nsym).encode(token))
+    elif version < 3:
+        # The header (and the digest table in version 2) before a Fernet token of the binary vote data
+        token = Fernet(derive_key(check_pin, backend.registry.salt)).encrypt(pack_tally(votes, backend.registry.digests))
+        codec = get_codec(profiles[default_profile])
+        encoded = bytes(codec.encode(token))
+        table = codec.digests(encoded) if version == 2 else b""
+        data = header.pack(header_magic, version, codec.nsym, codec.nsym ^ 0xff) + table + encoded
+    else:
+        data = backend.encrypt(backend._get_key(check_pin), votes)
+    with open(path(False, name), "wb") as file:
+        file.write(data)
+    backend.logout()
+    return votes
+
+
+def check_formats(rng) -> list:
+    """Reads vote files written in every format, clean and then damaged
+
+    :param rng: The random generator
+    :returns: The failed checks
+    """
+    failures = []
+    for version in range(header_version + 1):
+        name = f"format{version}"
+        try:
+            votes = write_vote_file(name, version)
+        except Exception as e:
+            failures.append(f"Version {version}: {e!r}")
+            continue
+        for state in ("clean", "damaged"):
+            if state == "damaged":
+                with open(path(False, name), "rb") as file:
+                    data = file.read()
+                start, end = unpack_header(data)[2]
+                # A few bad bytes in each chunk, within what every profile can correct
+                with open(path(False, name), "wb") as file:
+                    file.write(data[:start] + damage(data[start:end], 255, 8, rng) + data[end:])
+            backend, errors = open_election(name)
+            found = backend.read_votes(check_pin)
+            if errors or found != votes:
+                failures.append(f"Version {version} ({state}): {errors[0] if errors else 'wrong votes read'}")
+            backend.close()
+    return failures
+
+
+def check_pins() -> list:
+    """Checks the PIN of an election registered now (with a verifier) and of the earlier kinds (with a hash of the PIN)
+
+    :returns: The failed checks
+    """
+    failures = []
+    errors = []
+    Backend(errors.append).register("pins", check_pin, dict(check_candidates))
+    with open(path(True, "pins"), "rb") as file:
+        if pin_key in pickle.load(file):
+            failures.append("A hash of the PIN is stored for an election with a salt")
+    for name in ("pins", "format0", "format1"):
+        backend = open_election(name)[0]
+        if not backend.verify_pin(check_pin) or backend.verify_pin(check_pin + b"0") or backend.read_votes(b"0000"):
+            failures.append(f"The PIN of {name} isn't checked correctly")
+        backend.close()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks the codecs against reedsolo and reads every vote file format")
+    parser.add_argument("--seed", type=int, default=0, help="the random seed of the data and the damage")
+    parser.add_argument("--workers", type=int, default=2, help="the number of worker processes of the parallel codec")
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            ensure_dir(cand_path)
+            ensure_dir(vote_path)
+            failures = check_codecs(rng, args.workers) + check_formats(rng) + check_pins()
+        finally:
+            os.chdir(cwd)
+
+    for failure in failures:
+        print("[FAIL]", failure)
+    print(f"{len(failures)} checks failed" if failures else "All checks passed")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
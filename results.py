@@ -0,0 +1,95 @@
+"""
+Read-only HTTP results service
+
+Serves the results of an election as JSON at /results. The JSON is only
+built again when the Backend's tally version changes (that is, when ballots
+were stored), and every response carries an ETag, so dashboards polling
+with If-None-Match get a 304 Not Modified while nothing changes.
+"""
+
+import json
+import threading
+from uuid import uuid4
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from utils import *
+
+
+def build_results(backend, boards: list) -> dict:
+    """Builds the results of an election
+
+    :param backend: The Backend, with the candidate list of the election loaded
+    :param boards: The leaderboards of the election (see Backend.leaderboards)
+    :returns: The results, ready to be converted to JSON
+    """
+    categories = []
+    for board in boards:
+        candidates = [{"name": name, "votes": votes} for name, votes in zip(board.names, board.counts)]
+        categories.append({"name": board.category, "candidates": candidates,
+                           "winners": board.winners(), "margin": board.margin()})
+    return {"election": backend.vote_file_name, "categories": categories}
+
+
+class ResultsService:
+    """Keeps the results of an election, built again only when the tally changes"""
+    def __init__(self, backend, pin: bytes):
+        """Initialization for the service
+
+        :param backend: The Backend, with the candidate list of the election loaded
+        :param pin: The PIN of the election
+        """
+        self.backend = backend
+        self.pin = pin
+        self._lock = threading.Lock()  # The Backend isn't thread-safe
+        self._instance = uuid4().hex[:8]  # Keeps ETags from repeating after a restart
+        self._version = None
+        self._snapshot = None
+
+    def snapshot(self) -> tuple:
+        """Gets the current results
+
+        :returns: The ETag and the results as JSON
+        """
+        with self._lock:
+            # Only checks whether the vote files changed, unless they did
+            boards = self.backend.leaderboards(self.pin)
+            if self.backend.tally_version != self._version:
+                debug("Results: Building the results for version %d", self.backend.tally_version)
+                self._version = self.backend.tally_version
+                results = build_results(self.backend, boards)
+                results["version"] = self._version
+                etag = '"{}-{}"'.format(self._instance, self._version)
+                self._snapshot = (etag, json.dumps(results).encode())
+            return self._snapshot
+
+    def serve(self, host: str = default_host, port: int = default_results_port):
+        """Serves the results until interrupted
+
+        :param host: The address to listen on
+        :param port: The TCP port to listen on
+        """
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/results":
+                    self.send_error(404)
+                    return
+                etag, body = service.snapshot()
+                if etag in self.headers.get("If-None-Match", ""):
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                debug("Results: " + format, *args)
+
+        with ThreadingHTTPServer((host, port), Handler) as server:
+            server.serve_forever()
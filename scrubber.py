@@ -0,0 +1,312 @@
+"""
+Background integrity scrubber for the vote and candidate files
+
+Otherwise, a damaged vote file is only noticed when a Backend happens to read
+it, and its votes are lost when the next ballot is stored. The scrubber walks
+vote_path and cand_path, reading at a limited number of bytes per second so
+the disk is left to the voting. It checks each file without decrypting it.
+Every encoded part of the file is checked on its own: the vote file itself,
+each journal or ranked ballot record (and its length prefix), and each block
+of a slotted file. A part
+is checked against its digest table if it has one, and with the syndromes of
+its chunks otherwise. Parts written with the "none" profile have nothing to
+check them with, so their files are reported as unverified rather than clean.
+
+Parts that can be corrected are written back. Whole files are replaced in one
+step (see write_atomic). Slotted files are the exception: their blocks are
+rewritten in place, the same way SlottedFile writes them, because a running
+Backend keeps them mapped in memory. The repair is made while holding the
+lock Backends take to write the same files (see file_lock), after reading the
+file again: a file that changed while it was checked is left for the next
+pass. Files that can't be corrected are reported through the error handler.
+
+The files are spread across a pool of worker processes.
+Candidate lists aren't RS-encoded, so they can only be checked: a damaged
+one has to be restored from a backup.
+"""
+
+import threading
+from functools import partial
+from reedsolo import ReedSolomonError
+from utils import *
+from codec import get_codec, unpack_header, record_spans, record_prefix, record_header
+from slots import slots_header, slots_magic, slots_version
+
+
+scrub_rate = 8 * 1024 * 1024  # The default number of bytes read per second (None for no limit)
+scrub_interval = 3600         # The default number of seconds between two passes in the background
+vote_kinds = {".dat": "vote", ".log": "records", ".ranked": "records", ".slots": "slots"}  # Extension -> kind of file
+
+
+class ScrubException(Exception):
+    pass
+
+
+uncorrectable = (ReedSolomonError, ScrubException, ValueError, struct.error)
+
+
+def _check_encoded(codec, data: bytes, digests: bytes = None) -> tuple:
+    """Checks RS-encoded data, correcting it if needed
+
+    :param codec: The codec the data was encoded with
+    :param data: The encoded data
+    :param digests: The digest table written with the data, if any
+    :returns: The corrected data (None if it was clean) and the number of damaged chunks
+              (None if the data has no ECC symbols, so it can't be checked)
+    """
+    if not codec.nsym:
+        return None, None
+    damaged = codec.damaged(data, digests)
+    if not damaged:
+        return None, 0
+    return bytes(codec.decode(data, digests=digests)[1]), len(damaged)
+
+
+def _check_sealed(data: bytes) -> tuple:
+    """Checks a part written by Backend._seal, correcting it (and its digest table) if needed
+
+    :param data: The part, with its header
+    :returns: The corrected part (None if it was clean) and the number of damaged chunks (see _check_encoded)
+    """
+    version, nsym, (start, end), table = unpack_header(data)
+    codec = get_codec(nsym)
+    fixed, damaged = _check_encoded(codec, data[start:end], data[table[0]:table[1]] if table else None)
+    if fixed is None:
+        return None, damaged
+    repaired = bytearray(data)
+    repaired[start:end] = fixed
+    if table:
+        repaired[table[0]:table[1]] = codec.digests(fixed)
+    return bytes(repaired), damaged
+
+
+def _check_candidates(data: bytes) -> tuple:
+    """Checks that a candidate list can still be read (it can't be corrected)"""
+    try:
+        candidates = pickle.loads(data)
+    except Exception as e:
+        raise ScrubException("The candidate list can't be read: " + str(e))
+    if not isinstance(candidates, dict) or (pin_key not in candidates and verifier_key not in candidates):
+        raise ScrubException("The candidate list is incomplete")
+    return None, 0
+
+
+def _vote_parts(data: bytes) -> list:
+    """:returns: The (start, end, check) of the only part of a vote file"""
+    return [(0, len(data), _check_sealed)]
+
+
+def _check_prefix(expected: bytes, data: bytes) -> tuple:
+    """Checks the length prefix of a record against the one its length gives (see record_prefix)"""
+    return (None, 0) if data == expected else (expected, 1)
+
+
+def _record_parts(data: bytes) -> list:
+    """:returns: The (start, end, check) of each record of a journal or ranked ballot file, and of its length prefix
+    (a record cut short at the end is left to the Backend, which removes it)"""
+    parts = []
+    for prefix, start, end in record_spans(lambda position, size: data[position:position + size], len(data))[0]:
+        if start - prefix == record_header.size:  # Records written before the prefixes had a CRC can't be checked
+            parts.append((prefix, start, partial(_check_prefix, record_prefix(end - start))))
+        parts.append((start, end, _check_sealed))
+    return parts
+
+
+def _slot_parts(data: bytes) -> list:
+    """:returns: The (start, end, check) of each block of a slotted file"""
+    magic, version, nsym, group_size, count, list_digest = slots_header.unpack_from(data)
+    if magic != slots_magic or version != slots_version:
+        raise ScrubException("Unknown slotted file format")
+    blocks = -(-count // group_size) if group_size else 0
+    if not blocks:
+        return []
+    size, extra = divmod(len(data) - slots_header.size, blocks)
+    if extra or not size:
+        raise ScrubException("The slotted file doesn't hold whole blocks")
+    check = partial(_check_encoded, get_codec(nsym))
+    return [(start, start + size, check) for start in range(slots_header.size, len(data), size)]
+
+
+file_layouts = {"vote": _vote_parts, "records": _record_parts, "slots": _slot_parts,
+                "candidates": lambda data: [(0, len(data), _check_candidates)]}
+
+
+def scrub_file(name: str, kind: str, repair: bool = True) -> dict:
+    """Checks a file, writing back the parts that can be corrected
+
+    :param name: The path of the file
+    :param kind: The kind of file (see file_layouts)
+    :param repair: Whether to write the corrected parts back
+    :returns: The report: the status of the file (clean, repaired, correctable, damaged, changed, missing, or unverified
+              if parts of it have no ECC symbols to check them with), its size, the number of damaged chunks,
+              the number of corrected parts and the first error
+    """
+    report = {"file": name, "kind": kind, "status": "clean", "bytes": 0, "damaged_chunks": 0, "corrected": 0, "error": None}
+    try:
+        with open(name, "rb") as file:
+            data = stage("file_read", file.read)
+    except FileNotFoundError:
+        report["status"] = "missing"
+        return report
+    report["bytes"] = len(data)
+
+    fixes, unverified = [], False
+    try:
+        for start, end, check in file_layouts[kind](data):
+            try:
+                fixed, damaged = check(data[start:end])
+            except uncorrectable as e:
+                report["error"] = report["error"] or f"Byte {start}: {e}"
+                continue
+            if damaged is None:
+                unverified = True  # Written with the "none" profile
+                continue
+            report["damaged_chunks"] += damaged
+            if fixed is not None:
+                fixes.append((start, fixed))
+    except uncorrectable as e:
+        report["error"] = str(e)
+    report["corrected"] = len(fixes)
+
+    if fixes and repair:
+        # Backends hold the same lock while they write, so the file can't change between this read and the repair
+        with file_lock(splitext(name)[0]):
+            try:
+                with open(name, "rb") as file:
+                    changed = stage("file_read", file.read) != data
+            except FileNotFoundError:
+                changed = True
+            if changed:
+                report["status"] = "changed"  # Written by a Backend in the meantime, checked again next time
+                return report
+            if kind == "slots":
+                with open(name, "r+b") as file:
+                    for start, fixed in fixes:
+                        file.seek(start)
+                        file.write(fixed)
+                    file.flush()
+                    fsync(file.fileno())
+            else:
+                repaired = bytearray(data)
+                for start, fixed in fixes:
+                    repaired[start:start + len(fixed)] = fixed
+                stage("file_write", write_atomic, name, bytes(repaired))
+    if report["error"]:
+        report["status"] = "damaged"
+    elif fixes:
+        report["status"] = "repaired" if repair else "correctable"
+    elif unverified:
+        report["status"] = "unverified"
+    return report
+
+
+class Scrubber:
+    """Checks every vote and candidate file in passes, in the foreground or in a background thread"""
+    def __init__(self, error_handler, rate: int = scrub_rate, workers: int = 0, repair: bool = True):
+        """Initialization for the scrubber
+
+        :param error_handler: Called with a ScrubException for each file that can't be corrected
+        :param rate: The number of bytes read per second (None for no limit)
+        :param workers: The number of worker processes checking files at once (0 or 1 to stay serial)
+        :param repair: Whether to write the corrected parts back, or only report them
+        """
+        self.error_handler = error_handler
+        self.rate = rate
+        self.workers = workers if workers > 1 else 0
+        self.repair = repair
+        self.reports = []  # The reports of the last pass (see scrub_file)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def files(self) -> list:
+        """Finds the files to check
+
+        :returns: The (path, kind) of each vote file (including the shards) and each candidate list
+        """
+        files = []
+        for folder, kinds in ((vote_path, vote_kinds), (cand_path, {".dat": "candidates"})):
+            for root, dirs, names in os.walk(folder):
+                dirs.sort()
+                for name in sorted(names):
+                    kind = kinds.get(splitext(name)[1])
+                    if kind:
+                        files.append((os.path.join(root, name), kind))
+        return files
+
+    def _throttle(self, start: float, read: int) -> bool:
+        """Waits until reading more is within the rate
+
+        :param start: The time the pass started
+        :param read: The number of bytes read so far
+        :returns: Whether the scrubber was stopped in the meantime
+        """
+        wait = read / self.rate - (perf_counter() - start) if self.rate else 0
+        return self._stop.wait(wait) if wait > 0 else self._stop.is_set()
+
+    def scrub(self) -> list:
+        """Checks every file once, reporting those that can't be corrected
+
+        :returns: The report of each file checked (see scrub_file)
+        """
+        start, read = perf_counter(), 0
+        pool = None
+        if self.workers:
+            from concurrent.futures import ProcessPoolExecutor
+            pool = ProcessPoolExecutor(self.workers)
+        results = []
+        try:
+            for name, kind in self.files():
+                if self._throttle(start, read):
+                    break
+                read += getsize(name) if isfile(name) else 0
+                if pool:
+                    results.append(pool.submit(scrub_file, name, kind, self.repair))
+                else:
+                    results.append(scrub_file(name, kind, self.repair))
+            reports = [result.result() for result in results] if pool else results
+        finally:
+            if pool:
+                pool.shutdown(cancel_futures=True)
+
+        for report in reports:
+            if report["status"] == "damaged":
+                self.error_handler(ScrubException(f"{report['file']} can't be corrected: {report['error']}"))
+            elif report["status"] != "clean":
+                debug("Scrub: %s %s (%d damaged chunks)", report["file"], report["status"], report["damaged_chunks"])
+        debug("Scrub: %d files checked in %.2f seconds", len(reports), perf_counter() - start)
+        self.reports = reports
+        return reports
+
+    def run(self, interval: float = scrub_interval):
+        """Checks every file again and again, until stopped
+
+        :param interval: The number of seconds between the start of two passes
+        """
+        while not self._stop.is_set():
+            started = perf_counter()
+            try:
+                self.scrub()
+            except Exception as e:
+                self.error_handler(e)
+            self._stop.wait(max(0, interval - (perf_counter() - started)))
+
+    def start(self, interval: float = scrub_interval):
+        """Runs the passes in a background thread (see run)"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, args=(interval,), name="scrubber", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the passes, waiting for the current file to be checked"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+
+def summarize_reports(reports: list) -> dict:
+    """:returns: The number of files of each status"""
+    summary = {}
+    for report in reports:
+        summary[report["status"]] = summary.get(report["status"], 0) + 1
+    return summary
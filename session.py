@@ -0,0 +1,83 @@
+"""
+Sessions hold the encryption key of an election once the PIN is entered
+
+The key is derived from the PIN with scrypt, which is deliberately slow,
+so it is derived once per session instead of on every store and read.
+The candidate file of an election with a salt holds a verifier derived from the key
+(see pin_verifier) rather than a hash of the PIN, so guessing the PIN from it costs
+a scrypt derivation per guess. Elections registered before salts were added keep
+using the old key (see utils.get_key) and the hash of the PIN, and so do the checks
+of elections registered with a salt before the verifier was added.
+"""
+
+import hmac
+from time import monotonic
+from utils import *
+
+
+salt_size = 16             # The size of the salt stored in the candidate file
+kdf_params = dict(n=2 ** 14, r=8, p=1)  # The scrypt cost parameters
+session_timeout = 300      # The time (in seconds) after which an unused session expires
+
+
+def derive_key(pin: bytes, salt: bytes) -> bytes:
+    """Derives the Fernet key from the PIN using scrypt
+
+    :param pin: The PIN
+    :param salt: The salt of the election
+    :returns: The key
+    """
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+    return base64.urlsafe_b64encode(Scrypt(salt=salt, length=32, **kdf_params).derive(pin))
+
+
+def pin_verifier(key: bytes) -> bytes:
+    """Derives the value stored to check the PIN of an election with a salt
+
+    :param key: The key derived from the PIN (see derive_key)
+    :returns: The verifier: an HMAC of a fixed message, so it doesn't reveal the key
+    """
+    return hmac.new(base64.urlsafe_b64decode(key), b"PIN verifier", "sha256").digest()
+
+
+def check_verifier(key: bytes, verifier: bytes) -> bool:
+    """:returns: Whether the key matches the verifier stored in the candidate file"""
+    return hmac.compare_digest(pin_verifier(key), verifier)
+
+
+class Session:
+    """The encryption key and cipher of an election, kept until logout or timeout"""
+    def __init__(self, pin_hash: bytes, salt: bytes, pin: bytes, timeout: float = session_timeout):
+        """Derives the key for the session
+
+        :param pin_hash: The hash of the PIN stored in the candidate file (None for elections with a verifier)
+        :param salt: The salt stored in the candidate file (None for elections without one)
+        :param pin: The PIN, which must have been checked
+        :param timeout: The time (in seconds) after which the session expires if unused
+        """
+        self.pin_hash = pin_hash
+        self.salt = salt
+        self.timeout = timeout
+        self.key = stage("kdf", derive_key, pin, salt) if salt else get_key(pin_hash, pin)
+        self._pin_hash = get_pin_hash(pin)  # Only kept in memory, to check the PIN again without scrypt
+        from cryptography.fernet import Fernet
+        self.cipher = Fernet(self.key)
+        self._used_at = monotonic()
+
+    def matches(self, pin_hash: bytes, salt: bytes, pin: bytes) -> bool:
+        """Checks whether the session is still valid for the given election and PIN.
+        Using the session keeps it alive.
+
+        :returns: Whether the session can be used
+        """
+        if self.key is None or monotonic() - self._used_at > self.timeout:
+            self.logout()
+            return False
+        if (self.pin_hash, self.salt) != (pin_hash, salt) or get_pin_hash(pin) != self._pin_hash:
+            return False
+        self._used_at = monotonic()
+        return True
+
+    def logout(self):
+        """Forgets the key and the cipher"""
+        self.key = self.cipher = self._pin_hash = None
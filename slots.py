@@ -0,0 +1,148 @@
+"""
+Slotted vote files, for elections with many candidates
+
+The counters are stored in fixed slots, grouped into blocks. Each block is
+encrypted and RS-encoded on its own, and since every block has the same size,
+a block can be found and rewritten in place through mmap.
+Storing a ballot then only rewrites the blocks holding its candidates,
+instead of the whole vote file. Writes through mmap change neither the size
+nor (reliably) the modification time of the file, so each store moves the
+modification time forward itself, for the readers that watch it.
+"""
+
+import sys
+import mmap
+from time import time_ns
+from array import array
+from hashlib import sha224
+from utils import *
+from codec import get_codec
+
+
+slots_magic = b"VTS"
+slots_version = 1
+slots_header = struct.Struct("<3sBBHI28s")  # Magic, version, nsym, counters per block, number of candidates, candidate list digest
+block_index = struct.Struct("<I")  # Encrypted with each block, so blocks can't be swapped around
+slot_group_size = 16       # The number of counters in each block
+
+
+class SlotsException(Exception):
+    pass
+
+
+class SlottedFile:
+    """A vote file made of independently encrypted blocks of counters"""
+    def __init__(self, filename: str, digests: tuple, nsym: int, cipher, group_size: int = slot_group_size):
+        """Opens the slotted file, creating it with all counters at 0 if needed
+
+        :param filename: The path of the file
+        :param digests: The candidate hashes, in the order of the candidate file (see CandidateRegistry.digests)
+        :param nsym: The number of ECC symbols for a new file (an existing file keeps its own)
+        :param cipher: The Fernet object used to encrypt the blocks
+        :param group_size: The number of counters in each block of a new file
+        """
+        self.filename = filename
+        self.cipher = cipher
+        self.count = len(digests)
+        list_digest = sha224(b"".join(digests)).digest()
+        if not isfile(filename):
+            self._create(filename, nsym, group_size, list_digest)
+        self._file = open(filename, "r+b")
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+        magic, version, nsym, self.group_size, count, file_digest = slots_header.unpack_from(self._map)
+        if magic != slots_magic or version != slots_version:
+            self.close()
+            raise SlotsException("Unknown slotted file format")
+        if count != self.count or file_digest != list_digest:
+            self.close()
+            raise SlotsException("The slotted file belongs to a different candidate list")
+        self.codec = get_codec(nsym)
+        self.blocks = -(-self.count // self.group_size)
+        self.block_size = len(self._encode(0, array("Q", bytes(8 * self.group_size))))
+
+    def _create(self, filename: str, nsym: int, group_size: int, list_digest: bytes):
+        """Writes a new slotted file with all counters at 0
+        If another writer creates the file first, its file is kept (and opened instead),
+        since replacing it would leave that writer storing ballots in a file that's gone."""
+        self.codec, self.group_size = get_codec(nsym), group_size
+        zeros = array("Q", bytes(8 * group_size))
+        data = [slots_header.pack(slots_magic, slots_version, nsym, group_size, self.count, list_digest)]
+        data.extend(self._encode(block, zeros) for block in range(-(-self.count // group_size)))
+        write_atomic(filename, b"".join(data), exclusive=True)
+
+    def _encode(self, block: int, counts: array) -> bytes:
+        """Encrypts and encodes a block of counters"""
+        if sys.byteorder != "little":
+            counts = array("Q", counts)
+            counts.byteswap()
+        token = stage("fernet_encrypt", self.cipher.encrypt, block_index.pack(block) + counts.tobytes())
+        return stage("rs_encode", self.codec.encode, token)
+
+    def _offset(self, block: int) -> int:
+        """:returns: The position of the block in the file"""
+        return slots_header.size + block * self.block_size
+
+    def read_block(self, block: int) -> array:
+        """Reads a block of counters
+
+        :param block: The block number
+        :returns: The counters of the block
+        """
+        start = self._offset(block)
+        encoded = stage("file_read", self._map.__getitem__, slice(start, start + self.block_size))
+        data = stage("rs_decode", self.codec.decode, encoded)[0]
+        plain = stage("fernet_decrypt", self.cipher.decrypt, bytes(data))
+        if block_index.unpack_from(plain)[0] != block:
+            raise SlotsException("Block found at the wrong position")
+        counts = array("Q", plain[block_index.size:])
+        if sys.byteorder != "little":
+            counts.byteswap()
+        return counts
+
+    def write_block(self, block: int, counts: array):
+        """Writes a block of counters in place
+
+        :param block: The block number
+        :param counts: The counters of the block
+        """
+        start = self._offset(block)
+        stage("file_write", self._map.__setitem__, slice(start, start + self.block_size), self._encode(block, counts))
+
+    def read_counts(self) -> list:
+        """Reads every counter
+
+        :returns: The number of votes, indexed by candidate ID
+        """
+        counts = []
+        for block in range(self.blocks):
+            counts.extend(self.read_block(block))
+        return counts[:self.count]
+
+    def add(self, counts: dict, sync: bool = True):
+        """Adds votes to the counters, rewriting only the blocks that hold them
+
+        :param counts: The number of votes to add, by candidate ID
+        :param sync: Whether to wait until the blocks are safely on the disk
+        """
+        blocks = {}
+        for candidate in counts:
+            blocks.setdefault(candidate // self.group_size, []).append(candidate)
+        for block in blocks:
+            values = self.read_block(block)
+            for candidate in blocks[block]:
+                values[candidate % self.group_size] += counts[candidate]
+            self.write_block(block, values)
+        if sync:
+            self._map.flush()
+        self.touch()
+
+    def touch(self):
+        """Moves the modification time of the file forward, so the readers notice the blocks written"""
+        mtime = max(time_ns(), fstat(self._file.fileno()).st_mtime_ns + 1)
+        os.utime(self.filename, ns=(mtime, mtime))
+
+    def close(self):
+        """Closes the file"""
+        self._map.close()
+        self._file.close()
@@ -0,0 +1,105 @@
+"""
+Binary format of the vote data
+
+The vote data is stored as one unsigned 64-bit counter per candidate,
+in the order the candidates appear in the candidate file, after a header
+with the journal sequence number and a digest of the candidate list
+(so vote data is never read with the wrong candidate list).
+Reading it only needs a memoryview over the decrypted bytes, and unlike
+pickle it can't run code hidden in the data.
+
+Vote data with votes for only a few of the candidates (such as the journal
+records, which only hold the votes of one flush) is stored sparsely instead:
+the positions of those candidates (32-bit), then their counters.
+"""
+
+import sys
+import struct
+from array import array
+from hashlib import sha224
+from utils import *
+
+
+tally_magic = b"VTT"
+tally_version = 1   # One counter per candidate
+sparse_version = 2  # The positions of the candidates with votes, then their counters
+tally_header = struct.Struct("<3sBQI28s")  # Magic, version, sequence number, number of candidates, candidate list digest
+is_tally = lambda payload: payload[:len(tally_magic)] == tally_magic  # Older vote data is pickled instead
+
+
+class TallyException(Exception):
+    pass
+
+
+def pack_tally(data: dict, digests: list) -> bytes:
+    """Converts the vote data to the binary format, sparse if that's smaller
+
+    :param data: The vote data, with its sequence number
+    :param digests: The candidate hashes, in the order of the candidate file (see CandidateRegistry.digests)
+    :returns: The binary vote data
+    """
+    index = {digest: i for i, digest in enumerate(digests)}
+    votes = len(data) - (seq_key in data)
+    sparse = 12 * votes < 8 * len(digests)
+    if sparse:
+        positions, counts = array("I"), array("Q")
+    else:
+        counts = array("Q", bytes(8 * len(digests)))
+    for vote in data:
+        if vote == seq_key:
+            continue
+        if vote not in index:
+            raise TallyException("Vote for a candidate that isn't in the candidate list")
+        if sparse:
+            positions.append(index[vote])
+            counts.append(data[vote])
+        else:
+            counts[index[vote]] = data[vote]
+    if sys.byteorder != "little":
+        counts.byteswap()
+        if sparse:
+            positions.byteswap()
+    header = tally_header.pack(tally_magic, sparse_version if sparse else tally_version, data.get(seq_key, 0),
+                               len(digests), sha224(b"".join(digests)).digest())
+    return header + (positions.tobytes() if sparse else b"") + counts.tobytes()
+
+
+def unpack_tally(payload: bytes, digests: list) -> dict:
+    """Reads vote data in the binary format
+
+    :param payload: The binary vote data
+    :param digests: The candidate hashes, in the order of the candidate file (see CandidateRegistry.digests)
+    :returns: The vote data (without the candidates that have no votes), with its sequence number
+    """
+    magic, version, seq, count, list_digest = tally_header.unpack_from(payload)
+    if magic != tally_magic or version not in (tally_version, sparse_version):
+        raise TallyException("Unknown vote data format")
+    if count != len(digests) or list_digest != sha224(b"".join(digests)).digest():
+        raise TallyException("The vote data belongs to a different candidate list")
+    if version == sparse_version:
+        entries, extra = divmod(len(payload) - tally_header.size, 12)
+        if extra:
+            raise TallyException("Incomplete vote data")
+        positions = _unpack_array("I", payload, tally_header.size, entries)
+        counts = _unpack_array("Q", payload, tally_header.size + 4 * entries, entries)
+        if any(position >= count for position in positions):
+            raise TallyException("Vote for a candidate that isn't in the candidate list")
+        data = {digests[position]: votes for position, votes in zip(positions, counts) if votes}
+    else:
+        counts = _unpack_array("Q", payload, tally_header.size, (len(payload) - tally_header.size) // 8)
+        if len(counts) != count or len(payload) != tally_header.size + 8 * count:
+            raise TallyException("Incomplete vote data")
+        data = {digests[i]: counts[i] for i in range(count) if counts[i]}
+    data[seq_key] = seq
+    return data
+
+
+def _unpack_array(typecode: str, payload: bytes, offset: int, length: int):
+    """:returns: The little-endian integers at a position of the payload (a memoryview where the byte order allows it)"""
+    size = array(typecode).itemsize
+    view = memoryview(payload)[offset:offset + size * length]
+    if sys.byteorder == "little":
+        return view.cast(typecode)
+    values = array(typecode, view)
+    values.byteswap()
+    return values
@@ -1,30 +1,191 @@
 # Imports from the built-in library
 import pickle
 import base64
-from os.path import isfile, isdir
-from os import mkdir
+import struct
+import tempfile
+from itertools import islice
+from contextlib import contextmanager
+from time import perf_counter
+from os.path import isfile, isdir, getsize, splitext, dirname, basename
+import os
+from os import mkdir, remove, stat, fstat, urandom, listdir, replace, fsync
 from hashlib import sha224, sha256
 
-# Third-party package imports
-from cryptography.fernet import Fernet
-from reedsolo import RSCodec, ReedSolomonError
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not available on Windows, where the vote files aren't locked (see file_lock)
+
+# The heavy third-party packages (cryptography and numpy) are imported where they
+# are used, when they are first needed, so that starting up stays quick. reedsolo
+# is small and its ReedSolomonError is caught in several places, so codec.py
+# (and with it every Backend) imports it right away.
 
 
 # Global Parameters
 cand_path = "candidates/"  # The path where the candidate list will be stored
 vote_path = "votes/"       # The path where the votes will be stored
 pin_key = "-#*KEY*#-"      # The key of the dict item where the hash of the pin will be stored. It's best not to change it.
+profile_key = "-#*PROFILE*#-"  # The key of the dict item where the redundancy profile of the election will be stored
+salt_key = "-#*SALT*#-"    # The key of the dict item where the salt used to derive the encryption key will be stored
+verifier_key = "-#*VERIFIER*#-"  # The key of the dict item where the PIN verifier of elections with a salt will be stored
+seq_key = "-#*SEQ*#-"      # The key of the dict item where the journal sequence number is stored in vote data
 is_debug = False           # Enables debug messages
+is_instrumented = False    # Enables the timing of each stage (see stage()), set by instrument()
+durability_levels = ("none", "batched", "every-ballot")  # See the durability parameter of Backend
+default_host = "127.0.0.1" # The address the ballot daemon and the results service listen on (loopback only)
+default_port = 8765        # The TCP port of the ballot daemon (see daemon.py)
+default_results_port = 8080  # The TCP port of the results service (see results.py)
+election_footprint = 4096  # Rough memory use (in bytes) of an open election apart from its candidates and votes
+candidate_footprint = 256  # Rough memory use (in bytes) of each candidate in the candidate registry and leaderboards
+vote_footprint = 128       # Rough memory use (in bytes) of each entry of the vote data kept in memory
+read_size = 64 * 1024      # The number of bytes read at once when a vote file is read a piece at a time
 
 
 # Utility stuff - Such as getting the path of a file, get hash of a name & category, etc.
 # It is not necessary to fully understand them except the overall effect/result
 path = lambda is_cand, name: (cand_path if is_cand else vote_path) + name + ".dat"
+log_path = lambda name: vote_path + name + ".log"
+slots_path = lambda name: vote_path + name + ".slots"
+ranked_path = lambda name: vote_path + name + ".ranked"
+vote_extensions = (".dat", ".log", ".slots", ".ranked")  # The extensions of the files holding vote data
+reserved_keys = (pin_key, profile_key, salt_key, verifier_key)  # The keys in the candidate dict that aren't categories
 ensure_dir = lambda path: mkdir(path) if not isdir(path) else True
 get_hash = lambda cat, name: sha224((cat + "::" + name).encode()).digest()
 get_pin_hash = lambda pin: sha256(pin).digest()
 get_key = lambda pin_hash, pin: (base64.urlsafe_b64encode(pin_hash + pin).decode()[:43] + "=").encode() if get_pin_hash(pin) == pin_hash else False
-debug = lambda msg: print("[DEBUG]", msg) if is_debug else None
+debug = lambda msg, *args: print("[DEBUG]", msg % args if args else msg) if is_debug else None  # Only formats the message when debugging
+is_bytes = lambda data: isinstance(data, (bytes, bytearray, memoryview))
+stage_stats = {}           # Stage name -> [calls, seconds, bytes in, bytes out], see stage()
+
+
+def instrument(enabled: bool = True):
+    """Turns the timing of the stages on or off, and clears the statistics
+
+    :param enabled: Whether to time the stages
+    """
+    global is_instrumented
+    is_instrumented = enabled
+    stage_stats.clear()
+
+
+def stage(name: str, function, *args, **kwargs):
+    """Runs one stage of a hot path (such as RS encoding or a file read).
+    When instrumentation is on, the time taken is added to the statistics of the stage,
+    along with the size of the first bytes argument (bytes in) and of the result (bytes out).
+
+    :param name: The name of the stage
+    :param function: The function to run
+    :returns: The result of the function
+    """
+    if not is_instrumented:
+        return function(*args, **kwargs)
+    start = perf_counter()
+    result = function(*args, **kwargs)
+    seconds = perf_counter() - start
+    stats = stage_stats.setdefault(name, [0, 0.0, 0, 0])
+    stats[0] += 1
+    stats[1] += seconds
+    stats[2] += next((len(arg) for arg in args if is_bytes(arg)), 0)
+    output = result[0] if isinstance(result, tuple) and result else result  # RS decoding returns a tuple
+    stats[3] += len(output) if is_bytes(output) else 0
+    return result
+
+
+def stage_pieces(name: str, pieces):
+    """Passes on the pieces of an iterable, adding their size to the bytes in of a stage.
+    stage() only counts bytes arguments, so it's used for the pieces of a function
+    that takes its data a piece at a time (such as write_atomic).
+
+    :param name: The name of the stage
+    :param pieces: The pieces of bytes
+    :returns: A generator of the same pieces
+    """
+    for piece in pieces:
+        if is_instrumented:
+            stage_stats.setdefault(name, [0, 0.0, 0, 0])[2] += len(piece)
+        yield piece
+
+
+def stage_report() -> dict:
+    """:returns: The statistics of each stage (calls, seconds, bytes in and out) since instrument() was called"""
+    return {name: {"calls": calls, "seconds": seconds, "mean_ms": seconds / calls * 1000,
+                   "bytes_in": bytes_in, "bytes_out": bytes_out}
+            for name, (calls, seconds, bytes_in, bytes_out) in stage_stats.items()}
+
+
+def write_atomic(name: str, data: bytes, sync: bool = True, exclusive: bool = False) -> bool:
+    """Replaces the contents of a file in one step.
+    The data is written to a temporary file which then replaces the file,
+    so a crash leaves either the old or the new contents, never a mix.
+    Each write gets its own temporary file, so two processes writing
+    the same file at once can't mix their data either.
+
+    :param name: The path of the file
+    :param data: The new contents, as bytes or as an iterable of pieces (written as they come)
+    :param sync: Whether to wait until the data is safely on the disk (fsync)
+    :param exclusive: Whether to only create the file: a file that already exists
+                      (even one created by someone else in the meantime) is left as it is
+    :returns: Whether the file was written (always, unless exclusive)
+    """
+    descriptor, temp = tempfile.mkstemp(prefix=basename(name) + ".", suffix=".tmp", dir=dirname(name) or ".")
+    try:
+        with open(descriptor, "wb") as file:
+            try:
+                os.chmod(temp, stat(name).st_mode & 0o777)  # Keeps the permissions of the file it replaces
+            except FileNotFoundError:
+                pass  # A new file keeps the ones of mkstemp: only the owner can read it
+            for piece in (data,) if is_bytes(data) else data:
+                file.write(piece)
+            if sync:
+                file.flush()
+                fsync(file.fileno())
+        if exclusive:
+            try:
+                os.link(temp, name)  # Unlike replace, fails if the file exists
+            except FileExistsError:
+                return False
+            finally:
+                remove(temp)
+        else:
+            replace(temp, name)
+    except BaseException:
+        if isfile(temp):
+            remove(temp)
+        raise
+    if sync and hasattr(os, "O_DIRECTORY"):
+        # The rename itself is only durable once the folder is synced too
+        folder = os.open(dirname(name) or ".", os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            fsync(folder)
+        finally:
+            os.close(folder)
+    return True
+
+
+@contextmanager
+def file_lock(base: str):
+    """Holds an exclusive lock on the vote files with the given path.
+    Backends hold it while they write to their vote files, and the scrubber while it writes back
+    a repair, so neither overwrites what the other has just written. The lock is taken on a separate
+    .lock file, since a vote file is a different file after each write (see write_atomic).
+    It isn't reentrant: the same process can't take it twice at once.
+
+    :param base: The path of the vote files, without the extension
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(base + ".lock", "a") as file:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
 
 class PinException(Exception):
     pass
+
+class JournalException(Exception):
+    pass